@@ -0,0 +1,48 @@
+#сравнение пакетной оценки советов с поэлементной для больших выборок
+#запуск из корня репозитория: python -m benchmarks.bench_advice
+import argparse
+import random
+import time
+
+from climate_engine import WeatherEngine
+
+def make_rows(size, seed):
+    rng = random.Random(seed)
+    return (
+        [rng.uniform(-50, 50) for _ in range(size)],
+        [rng.uniform(0, 100) for _ in range(size)],
+        [rng.uniform(0, 90) for _ in range(size)],
+        [rng.randint(0, 100) for _ in range(size)]
+    )
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=13)
+    args = parser.parse_args()
+
+    engine = WeatherEngine(api_key='benchmark')
+    print(f"{'строк':>10} {'поэлементно, с':>16} {'пакетно, с':>12} {'ускорение':>10}")
+    for size in args.sizes:
+        temps, humidities, winds, precips = make_rows(size, args.seed)
+        scalar_time, scalar_result = best_of(args.repeat, lambda: [
+            engine.evaluate_weather(t, h, w, p) for t, h, w, p in zip(temps, humidities, winds, precips)
+        ])
+        batch_time, batch_result = best_of(args.repeat, lambda: engine.evaluate_weather_batch(
+            temps, humidities, winds, precips
+        ))
+        if scalar_result != batch_result:
+            raise SystemExit(f'Результаты расходятся для выборки из {size} строк')
+        print(f'{size:>10} {scalar_time:>16.4f} {batch_time:>12.4f} {scalar_time / batch_time:>9.1f}x')
+
+if __name__ == '__main__':
+    main()
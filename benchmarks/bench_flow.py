@@ -0,0 +1,103 @@
+#сквозной бенчмарк /weather -> forecast_N -> график без сети: AccuWeather и Telegram заменены заглушками
+#запуск из корня репозитория: python -m benchmarks.bench_flow --route-lengths 2 4 6 --users 1 10 50
+import argparse
+import asyncio
+import importlib
+import math
+import os
+import random
+import time
+
+from benchmarks.fake_accuweather import FakeAccuWeather, load_fixture
+from benchmarks.fake_telegram import FakeTelegramSession, UpdateDriver
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share / 100 * len(ordered)) - 1)]
+
+def configure_environment(base_url):
+    os.environ.setdefault('TOKEN', '123456:BENCHMARK')
+    os.environ['ACCUWEATHER_BASE_URL'] = base_url
+    os.environ['BOT_MODE'] = 'polling'
+    os.environ['SESSION_BACKEND'] = 'memory'
+    os.environ['LOCATION_CACHE_PATH'] = ':memory:'
+    os.environ['QUOTA_DB_PATH'] = ':memory:'
+    os.environ['SUBSCRIPTION_DB_PATH'] = ':memory:'
+    os.environ['ACCUWEATHER_DAILY_LIMIT'] = str(10 ** 9)
+    os.environ['ACCUWEATHER_RATE_PER_SECOND'] = str(10 ** 6)
+
+#холодный старт: сбрасываем кэши бота между сценариями
+def reset_caches(bot_module):
+    from charting_units import ChartCache
+    from climate_engine import ForecastCache, LocationCache
+
+    bot_module.weatherEngine.location_cache = LocationCache()
+    bot_module.weatherEngine.forecast_cache = ForecastCache()
+    bot_module.chartCache = ChartCache()
+
+async def run_scenario(driver, city_names, route_length, users, days, seed):
+    rng = random.Random(seed)
+    routes = [rng.sample(city_names, route_length) for _ in range(users)]
+    started = time.perf_counter()
+    timings = await asyncio.gather(*(
+        driver.weather_flow(1000 + idx, route, days) for idx, route in enumerate(routes)
+    ))
+    wall_time = time.perf_counter() - started
+    return [flow for flow, _ in timings], [forecast for _, forecast in timings], wall_time
+
+async def main_async(args):
+    server = FakeAccuWeather(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    base_url = await server.start()
+    configure_environment(base_url)
+    bot_module = importlib.import_module('main_bot')
+    session = FakeTelegramSession(latency=args.telegram_latency)
+    #диалог в бенчмарке идет без пауз пользователя, поэтому лимит 1 сообщение в секунду на чат
+    #заслоняет время работы бота; с --flood-limits ограничитель остается в цепочке, как у настоящей сессии
+    if args.flood_limits:
+        session.middleware(bot_module.sendScheduler)
+    bot_module.bot_instance.session = session
+    #процессы графиков запускаются до замеров, как при старте бота
+    for warmup in bot_module.warmChartPool():
+        warmup.result()
+    driver = UpdateDriver(bot_module.mainDispatcher, bot_module.bot_instance)
+    city_names = [location['LocalizedName'] for location in load_fixture('cities_search.json')]
+
+    print(f'Задержка AccuWeather: {args.latency * 1000:.0f} мс (+{args.jitter * 1000:.0f} мс), '
+          f'ошибки: {args.error_rate:.0%}, горизонт: {args.days} дн.')
+    print(f"{'городов':>8} {'польз.':>7} {'p50 диалог':>11} {'p99 диалог':>11} "
+          f"{'p50 прогноз':>12} {'p99 прогноз':>12} {'диалогов/с':>11} {'запросов API':>13}")
+    try:
+        for route_length in args.route_lengths:
+            for users in args.users:
+                if not args.warm:
+                    reset_caches(bot_module)
+                server.requests.clear()
+                flows, forecasts, wall_time = await run_scenario(
+                    driver, city_names, min(route_length, len(city_names)), users, args.days, args.seed
+                )
+                upstream = sum(count for endpoint, count in server.requests.items() if endpoint != 'errors')
+                print(f'{route_length:>8} {users:>7} '
+                      f'{percentile(flows, 50) * 1000:>9.1f}мс {percentile(flows, 99) * 1000:>9.1f}мс '
+                      f'{percentile(forecasts, 50) * 1000:>10.1f}мс {percentile(forecasts, 99) * 1000:>10.1f}мс '
+                      f'{users / wall_time:>11.1f} {upstream:>13}')
+    finally:
+        await bot_module.weatherEngine.close()
+        bot_module.chartPool.shutdown()
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--route-lengths', type=int, nargs='+', default=[2, 4, 6])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--days', type=int, choices=[1, 3, 5], default=5)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--flood-limits', action='store_true', help='включить ограничитель частоты Telegram')
+    parser.add_argument('--warm', action='store_true', help='не сбрасывать кэши между сценариями')
+    parser.add_argument('--seed', type=int, default=13)
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#локальная замена AccuWeather: отдает записанные ответы поиска городов и дневных прогнозов
+#с настраиваемой задержкой, долей ошибок и дневным лимитом ключа
+#отдельный запуск из корня репозитория: python -m benchmarks.fake_accuweather --port 8001 --latency 0.2
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+from collections import Counter
+
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as fixture_file:
+        return json.load(fixture_file)
+
+class FakeAccuWeather:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, daily_limit=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        #после daily_limit запросов ключ считается исчерпанным, как у настоящего AccuWeather
+        self.daily_limit = daily_limit
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._locations = load_fixture('cities_search.json')
+        self._forecast = load_fixture('daily_5day.json')
+        self._runner = None
+        self.base_url = None
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/locations/v1/cities/search', self._search)
+        app.router.add_get('/forecasts/v1/daily/1day/{location_key}', self._daily_1day)
+        app.router.add_get('/forecasts/v1/daily/5day/{location_key}', self._daily_5day)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    #задержка и внедрение ошибок общие для всех эндпоинтов
+    async def _simulate(self, endpoint):
+        self.requests[endpoint] += 1
+        served = sum(count for name, count in self.requests.items() if name not in ('errors', 'over_limit'))
+        if self.daily_limit is not None and served > self.daily_limit:
+            self.requests['over_limit'] += 1
+            raise web.HTTPServiceUnavailable(
+                text=json.dumps({
+                    'Code': 'ServiceUnavailable',
+                    'Message': 'The allowed number of requests has been exceeded.',
+                    'Reference': f'/{endpoint}'
+                }),
+                content_type='application/json'
+            )
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.requests['errors'] += 1
+            raise web.HTTPServiceUnavailable(reason='Injected error')
+
+    def _check_apikey(self, request):
+        if not request.query.get('apikey'):
+            raise web.HTTPUnauthorized()
+
+    async def _search(self, request):
+        self._check_apikey(request)
+        await self._simulate('search')
+        query = request.query.get('q', '').strip().casefold()
+        found = [
+            location for location in self._locations
+            if query in (location['LocalizedName'].casefold(), location['EnglishName'].casefold())
+        ]
+        return web.json_response(found)
+
+    def _forecast_for(self, location_key, days):
+        if not any(location['Key'] == location_key for location in self._locations):
+            raise web.HTTPNotFound()
+        payload = copy.deepcopy(self._forecast)
+        #у каждого города свой сдвиг температуры, чтобы графики различались
+        shift = int(location_key) % 7 - 3
+        for day_info in payload['DailyForecasts']:
+            for field in ('Temperature', 'RealFeelTemperature', 'RealFeelTemperatureShade'):
+                for bound in ('Minimum', 'Maximum'):
+                    day_info[field][bound]['Value'] = round(day_info[field][bound]['Value'] + shift, 1)
+        payload['DailyForecasts'] = payload['DailyForecasts'][:days]
+        return payload
+
+    async def _daily_1day(self, request):
+        self._check_apikey(request)
+        await self._simulate('1day')
+        return web.json_response(self._forecast_for(request.match_info['location_key'], 1))
+
+    async def _daily_5day(self, request):
+        self._check_apikey(request)
+        await self._simulate('5day')
+        return web.json_response(self._forecast_for(request.match_info['location_key'], 5))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--daily-limit', type=int, default=None)
+    args = parser.parse_args()
+
+    server = FakeAccuWeather(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, daily_limit=args.daily_limit
+    )
+    web.run_app(server.create_app(), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#подмена Telegram Bot API: сессия aiogram, которая отвечает на вызовы локально,
+#и драйвер, проводящий пользователя через диалог /weather без сети
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+from aiogram import methods
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message, PhotoSize, Update
+
+class FakeTelegramSession(BaseSession):
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self.sent = []
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (methods.AnswerCallbackQuery, methods.SetWebhook, methods.DeleteWebhook)):
+            return True
+
+        chat = Chat(id=method.chat_id, type='private')
+        if isinstance(method, methods.SendPhoto):
+            message_id = next(self._message_ids)
+            self.sent.append((method.chat_id, 'photo', method.photo if isinstance(method.photo, str) else None))
+            return Message(
+                message_id=message_id, date=int(time.time()), chat=chat,
+                photo=[PhotoSize(file_id=f'photo-{message_id}', file_unique_id=f'u{message_id}', width=900, height=500)]
+            )
+        if isinstance(method, methods.EditMessageText):
+            self.sent.append((method.chat_id, 'edit', method.text))
+            return Message(message_id=method.message_id, date=int(time.time()), chat=chat, text=method.text)
+        if isinstance(method, methods.SendMessage):
+            self.sent.append((method.chat_id, 'text', method.text))
+            return Message(message_id=next(self._message_ids), date=int(time.time()), chat=chat, text=method.text)
+        raise NotImplementedError(f'Метод {type(method).__name__} не поддерживается заглушкой')
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+#собирает апдейты так, как их прислал бы Telegram, и прогоняет их через диспетчер
+class UpdateDriver:
+    def __init__(self, dispatcher, bot):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+    async def _feed(self, payload):
+        payload['update_id'] = next(self._update_ids)
+        update = Update.model_validate(payload, context={'bot': self.bot})
+        await self.dispatcher.feed_update(self.bot, update)
+
+    async def send_text(self, user_id, text):
+        await self._feed({'message': {
+            'message_id': next(self._update_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), 'text': text
+        }})
+
+    async def send_location(self, user_id, latitude, longitude):
+        await self._feed({'message': {
+            'message_id': next(self._update_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id),
+            'location': {'latitude': latitude, 'longitude': longitude}
+        }})
+
+    async def press_button(self, user_id, callback_data):
+        await self._feed({'callback_query': {
+            'id': str(next(self._update_ids)), 'from': self._user(user_id), 'chat_instance': str(user_id),
+            'data': callback_data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': ''}
+        }})
+
+    #полный диалог: /weather, начало и конец маршрута, промежуточные города, выбор периода и график;
+    #возвращает время всего диалога и отдельно шага прогноза с графиком
+    async def weather_flow(self, user_id, route, days, chart=True):
+        chart_buttons = {1: 'show_chart_1', 3: 'display_3_chart', 5: 'display_5_chart'}
+        started = time.perf_counter()
+        await self.send_text(user_id, '/weather')
+        await self.send_text(user_id, route[0])
+        await self.send_text(user_id, route[-1] if len(route) > 1 else route[0])
+        for stopover in route[1:-1]:
+            await self.press_button(user_id, 'wanna_stop')
+            await self.send_text(user_id, stopover)
+        await self.press_button(user_id, 'no_stop')
+
+        forecast_started = time.perf_counter()
+        await self.press_button(user_id, f'forecast_{days}')
+        if chart:
+            await self.press_button(user_id, chart_buttons[days])
+        finished = time.perf_counter()
+        return finished - started, finished - forecast_started
@@ -1,74 +1,91 @@
-import matplotlib.pyplot as plt
-import pandas as pd
-import uuid
+import hashlib
+import io
+import json
+import time
+from collections import OrderedDict
 
-def create_single_day_chart(temperatures, city_labels):
-    plt.figure(figsize=(9, 5))
-    plt.bar(city_labels, temperatures, color='limegreen')
-    plt.xlabel('Названия городов')
-    plt.ylabel('Температура (°C)')
-    plt.title('Сравнение температур (1 день)')
-    plt.xticks(rotation=45)
+#объектный API matplotlib без глобального состояния pyplot,
+#поэтому графики можно строить параллельно из потоков и процессов
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
-    filename = f'single_day_{uuid.uuid4()}.png'
-    plt.savefig(filename, bbox_inches='tight')
-    plt.close()
-    return filename
+#кэш готовых графиков по хэшу типа графика и его данных (город, дата, температура),
+#ограничен суммарным размером PNG и вытесняет давно не использованные графики
+class ChartCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, reuse_file_ids=True):
+        self.max_bytes = max_bytes
+        self.reuse_file_ids = reuse_file_ids
+        self.total_bytes = 0
+        self._entries = OrderedDict()
 
-def create_three_day_chart(cities_data):
-    tmp_records = []
-    for city, day_temp_list in cities_data.items():
-        for date_str, tmp_val in day_temp_list[:3]:
-            tmp_records.append({
-                'Город': city,
-                'Дата': date_str,
-                'Температура': tmp_val
-            })
+    #порядок городов не сортируется: от него зависят порядок легенды и цвета линий
+    @staticmethod
+    def key(chart_type, *series):
+        payload = json.dumps([chart_type, series], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-    df = pd.DataFrame(tmp_records)
+    def get(self, chart_key):
+        entry = self._entries.get(chart_key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(chart_key)
+        return entry['png'], entry['file_id']
 
-    plt.figure(figsize=(9, 5))
-    for city_name in df['Город'].unique():
-        subset = df[df['Город'] == city_name]
-        plt.plot(subset['Дата'], subset['Температура'], marker='o', label=city_name)
+    def put(self, chart_key, png_bytes):
+        if chart_key in self._entries:
+            self.total_bytes -= len(self._entries.pop(chart_key)['png'])
+        if len(png_bytes) > self.max_bytes:
+            return
+        self._entries[chart_key] = {'png': png_bytes, 'file_id': None}
+        self.total_bytes += len(png_bytes)
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted['png'])
 
-    plt.title('Температура за 3 дня')
-    plt.xlabel('Дата')
-    plt.ylabel('Температура (°C)')
-    plt.xticks(rotation=45)
-    plt.grid(True)
-    plt.legend()
+    #file_id первой загрузки в Telegram позволяет не отправлять картинку повторно
+    def remember_file_id(self, chart_key, file_id):
+        if self.reuse_file_ids and chart_key in self._entries:
+            self._entries[chart_key]['file_id'] = file_id
 
-    filename = f'three_day_{uuid.uuid4()}.png'
-    plt.savefig(filename, bbox_inches='tight')
-    plt.close()
-    return filename
+    def forget_file_id(self, chart_key):
+        if chart_key in self._entries:
+            self._entries[chart_key]['file_id'] = None
 
-def create_five_day_chart(cities_data):
-    tmp_records = []
-    for city, day_temp_list in cities_data.items():
-        for date_str, tmp_val in day_temp_list:
-            tmp_records.append({
-                'Город': city,
-                'Дата': date_str,
-                'Температура': tmp_val
-            })
+def days_title(days):
+    if days == 1:
+        return '1 день'
+    if 2 <= days <= 4:
+        return f'{days} дня'
+    return f'{days} дней'
 
-    df = pd.DataFrame(tmp_records)
+#общий движок графиков: series - словарь город -> {'dates': [...], 'temps': [...]},
+#chart_kind 'bar' сравнивает первое значение каждого города, 'line' рисует ряды по датам
+def render_chart(chart_kind, title, series):
+    figure = Figure(figsize=(9, 5))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
 
-    plt.figure(figsize=(9, 5))
-    for city_name in df['Город'].unique():
-        subset = df[df['Город'] == city_name]
-        plt.plot(subset['Дата'], subset['Температура'], marker='o', label=city_name)
+    if chart_kind == 'bar':
+        cities = list(series.keys())
+        axes.bar(cities, [columns['temps'][0] for columns in series.values()], color='limegreen')
+        axes.set_xlabel('Названия городов')
+    else:
+        for city, columns in series.items():
+            axes.plot(columns['dates'], columns['temps'], marker='o', label=city)
+        axes.set_xlabel('Дата')
+        axes.grid(True)
+        axes.legend()
 
-    plt.title('Температура за 5 дней')
-    plt.xlabel('Дата')
-    plt.ylabel('Температура (°C)')
-    plt.xticks(rotation=45)
-    plt.grid(True)
-    plt.legend()
+    axes.set_ylabel('Температура (°C)')
+    axes.set_title(title)
+    axes.tick_params(axis='x', labelrotation=45)
 
-    filename = f'five_day_{uuid.uuid4()}.png'
-    plt.savefig(filename, bbox_inches='tight')
-    plt.close()
-    return filename
\ No newline at end of file
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
+
+#выполняется в рабочем процессе: возвращает PNG и чистое время построения для метрик
+def render_timed(chart_function, *args):
+    started = time.perf_counter()
+    png_bytes = chart_function(*args)
+    return png_bytes, time.perf_counter() - started
@@ -0,0 +1,123 @@
+import difflib
+import json
+import re
+import time
+import unicodedata
+
+from geo_index import BUNDLED_CITIES_PATH
+
+_TRANSLITERATION = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y',
+    'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
+})
+
+#распространенные сокращения, значения уже в виде ключей
+BUILTIN_ALIASES = {
+    'msk': 'moskva',
+    'mosk': 'moskva',
+    'spb': 'sankt peterburg',
+    'piter': 'sankt peterburg',
+    'peterburg': 'sankt peterburg',
+    'ekb': 'ekaterinburg',
+    'nsk': 'novosibirsk',
+    'nn': 'nizhnii novgorod',
+    'n novgorod': 'nizhnii novgorod',
+    'rostov': 'rostov na donu',
+    'vladik': 'vladivostok',
+}
+
+_SEPARATORS = re.compile(r"[\s\-_.,'’`\"()]+")
+
+def normalizeCityName(city_name):
+    text = unicodedata.normalize('NFKC', city_name).casefold().replace('ё', 'е')
+    return _SEPARATORS.sub(' ', text).strip()
+
+def transliterate(text):
+    text = text.translate(_TRANSLITERATION)
+    #диакритика латиницы: zürich -> zurich
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+#единый ключ города: регистр, пробелы, юникод, кириллица и известные сокращения сводятся к одной строке
+def aliasKey(city_name):
+    key = transliterate(normalizeCityName(city_name))
+    return BUILTIN_ALIASES.get(key, key)
+
+def _trigrams(key):
+    padded = f'  {key} '
+    return {padded[idx:idx + 3] for idx in range(len(padded) - 2)}
+
+#известные названия городов с триграммным индексом для подсказок при опечатках
+#и память о неудачных поисках, чтобы повторная опечатка не тратила квоту
+class AliasIndex:
+    def __init__(self, auto_match_ratio=0.8, failed_ttl=24 * 3600):
+        self.auto_match_ratio = auto_match_ratio
+        self.failed_ttl = failed_ttl
+        self._display = {}
+        self._trigram_keys = {}
+        self._failed = {}
+
+    def add(self, city_name, display_name=None):
+        key = aliasKey(city_name)
+        if not key:
+            return key
+        if key not in self._display:
+            for trigram in _trigrams(key):
+                self._trigram_keys.setdefault(trigram, set()).add(key)
+        if display_name or key not in self._display:
+            self._display[key] = display_name or city_name
+        return key
+
+    def load_bundled(self, path=BUNDLED_CITIES_PATH):
+        with open(path, encoding='utf-8') as cities_file:
+            for city in json.load(cities_file):
+                self.add(city['name'], city['name'])
+
+    def __contains__(self, city_name):
+        return aliasKey(city_name) in self._display
+
+    def display_name(self, key):
+        return self._display.get(key, key)
+
+    #похожие известные ключи по убыванию сходства: (ключ, сходство от 0 до 1)
+    def suggest(self, city_name, limit=3, min_ratio=0.6):
+        key = aliasKey(city_name)
+        candidates = {}
+        for trigram in _trigrams(key):
+            for candidate in self._trigram_keys.get(trigram, ()):
+                candidates[candidate] = candidates.get(candidate, 0) + 1
+        #точное сходство считается только для кандидатов с наибольшим числом общих триграмм
+        shortlisted = sorted(candidates, key=candidates.get, reverse=True)[:limit * 5]
+        scored = [(candidate, difflib.SequenceMatcher(None, key, candidate).ratio()) for candidate in shortlisted]
+        scored = [item for item in scored if item[1] >= min_ratio and item[0] != key]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:limit]
+
+    #очень близкое совпадение с известным названием, которым можно заменить опечатку
+    def auto_match(self, city_name):
+        key = aliasKey(city_name)
+        if len(key) < 4:
+            return None
+        suggestions = self.suggest(city_name, limit=1, min_ratio=self.auto_match_ratio)
+        return suggestions[0][0] if suggestions else None
+
+    #неудачный поиск запоминается вместе с найденным исправлением (или None)
+    def remember_failed(self, city_name, correction=None):
+        self._failed[aliasKey(city_name)] = (time.time() + self.failed_ttl, correction)
+
+    def _failed_entry(self, city_name):
+        key = aliasKey(city_name)
+        entry = self._failed.get(key)
+        if entry is not None and entry[0] <= time.time():
+            del self._failed[key]
+            return None
+        return entry
+
+    def recently_failed(self, city_name):
+        return self._failed_entry(city_name) is not None
+
+    def correction(self, city_name):
+        entry = self._failed_entry(city_name)
+        return entry[1] if entry is not None else None
@@ -1,122 +1,532 @@
-import requests
+import asyncio
+import operator
+import time
+from collections import Counter, OrderedDict
+
+import aiohttp
+import numpy as np
+
+import metrics
+from city_aliases import AliasIndex, aliasKey
+from forecast_models import CitySeries
+from quota_manager import QuotaExceededError, requestPriority
+from sqlite_support import connectSqlite
+
+_COMPARATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+#таблица советов по погоде: правила проверяются по порядку, срабатывает первое,
+#у которого выполнены все условия (поле, оператор, граница)
+_ADVICE_TABLE = (
+    ("На улице слишком холодно, рекомендуется оставаться дома",
+     (('temperature', '<=', -40),)),
+    ("Сильный шторм ожидается, соблюдайте осторожность",
+     (('wind_speed', '>=', 75),)),
+    ("Погода хорошая: умеренный ветер, тепло и маловероятен дождь",
+     (('wind_speed', '>=', 11), ('wind_speed', '<', 30), ('temperature', '>', 15), ('temperature', '<', 25),
+      ('precip_chance', '<', 30))),
+    ("Температура высокая, будьте осторожны при выходе",
+     (('temperature', '>', 40), ('precip_chance', '<', 30))),
+    ("Жаркая погода с вероятностью дождя, рекомендуем взять зонт",
+     (('temperature', '>', 40), ('precip_chance', '>=', 30), ('precip_chance', '<=', 75))),
+    ("Очень высокая температура и большой шанс дождя, стоит оставаться дома",
+     (('temperature', '>', 40), ('precip_chance', '>', 75))),
+    ("Прохладно, но возможен дождь — одевайтесь по сезону и берите зонт",
+     (('temperature', '>=', 0), ('temperature', '<=', 15), ('wind_speed', '<=', 20), ('precip_chance', '>', 50))),
+    ("Прохладно, дождь маловероятен, но стоит надеть легкую верхнюю одежду",
+     (('temperature', '>=', 0), ('temperature', '<=', 15), ('wind_speed', '<=', 20))),
+    ("Ветер сильный, температура низкая — лучше остаться дома",
+     (('temperature', '>=', 0), ('temperature', '<=', 15), ('wind_speed', '>', 20))),
+    ("Температура ниже нуля и дождь — хороший повод для катания на коньках",
+     (('temperature', '<', 0), ('precip_chance', '>', 70))),
+    ("Минусовая температура и сильный ветер — рекомендуем оставаться внутри",
+     (('temperature', '<', 0), ('wind_speed', '>=', 40))),
+    ("Температура ниже нуля, но относительно комфортно",
+     (('temperature', '<', 0),)),
+    ("Дождь с умеренным ветром и приятной температурой, будьте готовы к изменениям",
+     (('temperature', '>', 15), ('temperature', '<=', 40), ('precip_chance', '>', 55), ('wind_speed', '<=', 20))),
+    ("Дождь и ветер — неблагоприятные условия",
+     (('temperature', '>', 15), ('temperature', '<=', 40), ('precip_chance', '>', 55))),
+    ("Умеренный ветер с отсутствием дождя — зависит от ваших предпочтений",
+     (('temperature', '>', 15), ('temperature', '<=', 40), ('precip_chance', '<=', 55), ('wind_speed', '<=', 20))),
+    ("Умеренный ветер без дождя — выбор за вами",
+     (('temperature', '>', 15), ('temperature', '<=', 40), ('wind_speed', '>', 20))),
+    ("Не могу точно оценить погоду, условия неопределенные",
+     ()),
+)
+
+#таблица разбирается один раз при импорте модуля
+ADVICE_RULES = tuple(
+    (advice, tuple((field, _COMPARATORS[op], bound) for field, op, bound in conditions))
+    for advice, conditions in _ADVICE_TABLE
+)
+ADVICE_TEXTS = np.array([advice for advice, _ in ADVICE_RULES], dtype=object)
+
+#поиск AccuWeather не нашел город
+class CityNotFoundError(Exception):
+    pass
+
+#кэш соответствия название города -> ключ локации AccuWeather и координаты,
+#хранится в SQLite чтобы переживать перезапуски бота; названия хранятся в виде ключей aliasKey
+class LocationCache:
+    def __init__(self, path=':memory:', max_entries=10000, ttl=30 * 24 * 3600, touch_interval=30,
+                 touch_batch=256):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        #время последнего использования копится в памяти и записывается пачкой, чтобы чтение оставалось чтением
+        self.touch_interval = touch_interval
+        self.touch_batch = touch_batch
+        self._touched = {}
+        self._touched_at = time.monotonic()
+        self._db = connectSqlite(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS locations ('
+            'query TEXT PRIMARY KEY, location_key TEXT NOT NULL, '
+            'latitude REAL, longitude REAL, expires_at REAL NOT NULL, last_used REAL NOT NULL, display_name TEXT)'
+        )
+        #в кэшах, созданных до появления названий для показа, колонку нужно добавить
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(locations)')}
+        if 'display_name' not in columns:
+            self._db.execute('ALTER TABLE locations ADD COLUMN display_name TEXT')
+        self._db.execute('CREATE INDEX IF NOT EXISTS locations_last_used ON locations (last_used)')
+        self._db.commit()
+
+    #устаревшие записи не удаляются сразу: они нужны как запасной вариант при исчерпании квоты
+    def get(self, query, allow_stale=False):
+        query = aliasKey(query)
+        now = time.time()
+        row = self._db.execute(
+            'SELECT location_key, latitude, longitude, expires_at FROM locations WHERE query = ?',
+            (query,)
+        ).fetchone()
+        if row is None or (row[3] <= now and not allow_stale):
+            return None
+        self._touched[query] = now
+        if len(self._touched) >= self.touch_batch or time.monotonic() - self._touched_at >= self.touch_interval:
+            self._flushTouches()
+        return row[0], row[1], row[2]
+
+    def _writeTouches(self):
+        self._touched_at = time.monotonic()
+        if self._touched:
+            self._db.executemany(
+                'UPDATE locations SET last_used = ? WHERE query = ?',
+                [(last_used, query) for query, last_used in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _flushTouches(self):
+        self._writeTouches()
+        self._db.commit()
+
+    #записи вида (ключ названия, ключ локации, широта, долгота, название для показа или None)
+    def entries(self):
+        return self._db.execute(
+            'SELECT query, location_key, latitude, longitude, display_name FROM locations WHERE expires_at > ?',
+            (time.time(),)
+        ).fetchall()
+
+    def put(self, query, location_key, latitude, longitude, display_name=None):
+        #перед вытеснением LRU время использования должно быть актуальным
+        self._writeTouches()
+        now = time.time()
+        self._db.execute(
+            'INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (aliasKey(query), location_key, latitude, longitude, now + self.ttl, now, display_name)
+        )
+        #вытесняем давно не использованные записи сверх лимита
+        self._db.execute(
+            'DELETE FROM locations WHERE query IN ('
+            'SELECT query FROM locations ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+        self._db.commit()
+
+    def close(self):
+        self._flushTouches()
+        self._db.close()
+
+#кэш разобранных 5-дневных прогнозов по ключу локации, из него отдаются прогнозы на 1, 3 и 5 дней
+class ForecastCache:
+    def __init__(self, ttl=3600, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, location_key, allow_stale=False):
+        entry = self._entries.get(location_key)
+        if entry is None:
+            return None
+        expires_at, series = entry
+        if expires_at <= time.time() and not allow_stale:
+            return None
+        self._entries.move_to_end(location_key)
+        return series
+
+    def expires_at(self, location_key):
+        entry = self._entries.get(location_key)
+        return entry[0] if entry is not None else None
+
+    def put(self, location_key, series):
+        self._entries[location_key] = (time.time() + self.ttl, series)
+        self._entries.move_to_end(location_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+#тот же кэш прогнозов в SQLite: в режиме webhook его делят все процессы, поэтому прогноз города
+#запрашивается у AccuWeather один раз, а не в каждом процессе. Чтение ничего не пишет,
+#поэтому сверх лимита вытесняются записи, которые раньше всех истекают
+class SqliteForecastCache:
+    def __init__(self, path, ttl=3600, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._db = connectSqlite(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS forecasts ('
+            'location_key TEXT PRIMARY KEY, series TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS forecasts_expires_at ON forecasts (expires_at)')
+        self._db.commit()
+
+    def get(self, location_key, allow_stale=False):
+        row = self._db.execute(
+            'SELECT series, expires_at FROM forecasts WHERE location_key = ?', (location_key,)
+        ).fetchone()
+        if row is None or (row[1] <= time.time() and not allow_stale):
+            return None
+        return CitySeries.from_json(row[0])
+
+    def expires_at(self, location_key):
+        row = self._db.execute(
+            'SELECT expires_at FROM forecasts WHERE location_key = ?', (location_key,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, location_key, series):
+        self._db.execute(
+            'INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?)',
+            (location_key, series.to_json(), time.time() + self.ttl)
+        )
+        self._db.execute(
+            'DELETE FROM forecasts WHERE location_key IN ('
+            'SELECT location_key FROM forecasts ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
 
 class WeatherEngine:
     URL_LOCATION_SEARCH = 'http://dataservice.accuweather.com/locations/v1/cities/search'
     URL_1DAY_FORECAST = 'http://dataservice.accuweather.com/forecasts/v1/daily/1day/'
     URL_5DAY_FORECAST = 'http://dataservice.accuweather.com/forecasts/v1/daily/5day/'
 
-    def __init__(self, api_key):
+    #коды ответа, при которых запрос имеет смысл повторить
+    RETRYABLE_STATUSES = {500, 502, 503, 504}
+    #так AccuWeather сообщает об исчерпанном лимите ключа: 429 или 503 с этим текстом
+    OVER_LIMIT_STATUSES = {429, 503}
+    OVER_LIMIT_MESSAGE = 'allowed number of requests has been exceeded'
+
+    def __init__(self, api_key, base_url=None, total_timeout=10, connect_timeout=3, pool_size=20,
+                 keepalive_timeout=30, max_retries=3, backoff_base=0.5, location_cache=None,
+                 forecast_cache=None, route_concurrency=4, quota=None, geo_index=None, alias_index=None):
         self.api_key = api_key
+        #другой адрес API, например локальный сервер-заглушка для бенчмарков
+        if base_url:
+            base_url = base_url.rstrip('/')
+            self.URL_LOCATION_SEARCH = base_url + '/locations/v1/cities/search'
+            self.URL_1DAY_FORECAST = base_url + '/forecasts/v1/daily/1day/'
+            self.URL_5DAY_FORECAST = base_url + '/forecasts/v1/daily/5day/'
+        self.quota = quota
+        self.geo_index = geo_index
+        self.alias_index = alias_index or AliasIndex()
+        self.route_concurrency = route_concurrency
+        self.location_cache = location_cache or LocationCache()
+        self.forecast_cache = forecast_cache or ForecastCache()
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._session = None
+        #одинаковые запросы, выполняющиеся в данный момент: (эндпоинт, ключ) -> задача
+        self._inflight = {}
+        self.upstream_calls = Counter()
+        self.coalesced_calls = Counter()
+        #сколько раз запрашивали прогноз по каждому ключу локации, по этим данным прогреваются популярные города
+        self.request_counts = Counter()
+
+    #общая сессия с пулом keep-alive соединений, создается лениво внутри event loop
+    def _getSession(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    #конкурентные вызовы с одинаковым ключом ждут один запрос и получают общий результат
+    #задача запроса выполняется с приоритетом вызова, который ее создал, поэтому пользовательский вызов
+    #не присоединяется к фоновому запросу (прогрев, рассылка), а фоновый может ждать пользовательский
+    async def _singleFlight(self, endpoint, request_key, request_factory):
+        priority = requestPriority.get()
+        task = None
+        for flight_priority in range(priority + 1):
+            task = self._inflight.get((endpoint, request_key, flight_priority))
+            if task is not None:
+                break
+        flight_key = (endpoint, request_key, priority)
+        if task is not None:
+            self.coalesced_calls[endpoint] += 1
+            metrics.UPSTREAM_COALESCED.labels(endpoint).inc()
+        else:
+            self.upstream_calls[endpoint] += 1
+            task = asyncio.ensure_future(request_factory())
+            self._inflight[flight_key] = task
+
+            def forget(done_task):
+                if self._inflight.get(flight_key) is done_task:
+                    del self._inflight[flight_key]
+
+            task.add_done_callback(forget)
+        #shield не дает отмене одного ожидающего прервать запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _requestJson(self, endpoint, url, params):
+        attempt = 0
+        while True:
+            if self.quota is not None:
+                await self.quota.acquire(endpoint)
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                with metrics.span('upstream', endpoint=endpoint, attempt=attempt):
+                    async with self._getSession().get(url, params=params) as resp:
+                        status = resp.status
+                        if status in self.OVER_LIMIT_STATUSES and await self._isOverLimit(resp):
+                            #повторы не помогут до конца дня, вызывающий код перейдет на устаревший кэш
+                            if self.quota is not None:
+                                self.quota.exhaust()
+                            raise QuotaExceededError('Исчерпан дневной лимит запросов к AccuWeather')
+                        resp.raise_for_status()
+                        return await resp.json(content_type=None)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) as ex:
+                if isinstance(ex, asyncio.TimeoutError):
+                    status = 'timeout'
+                retryable = not isinstance(ex, aiohttp.ClientResponseError) or ex.status in self.RETRYABLE_STATUSES
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff_base * (2 ** attempt))
+                attempt += 1
+            finally:
+                metrics.UPSTREAM_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+                metrics.UPSTREAM_RESPONSES.labels(endpoint, status).inc()
 
-    def retrieveGeoCoordinates(self, city_name):
+    async def _isOverLimit(self, resp):
+        if resp.status == 429:
+            return True
+        return self.OVER_LIMIT_MESSAGE in (await resp.text()).lower()
+
+    #один поисковый запрос заполняет и ключ, и координаты города
+    async def _resolveLocation(self, city_name, allow_correction=True):
+        cached = self.location_cache.get(city_name)
+        if cached is not None:
+            metrics.CACHE_REQUESTS.labels('location', 'hit').inc()
+            return cached
+        #название уже не находилось: повторный поиск не тратит квоту
+        if self.alias_index.recently_failed(city_name):
+            correction = self.alias_index.correction(city_name)
+            if correction is None or not allow_correction:
+                metrics.CACHE_REQUESTS.labels('location', 'negative').inc()
+                raise CityNotFoundError(self._notFoundMessage(city_name))
+            metrics.CACHE_REQUESTS.labels('location', 'corrected').inc()
+            return await self._resolveLocation(self.alias_index.display_name(correction), allow_correction=False)
+        metrics.CACHE_REQUESTS.labels('location', 'miss').inc()
         try:
-            params = {
-                'apikey': self.api_key,
-                'q': city_name
-            }
-            resp = requests.get(self.URL_LOCATION_SEARCH, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-            lat = data[0]['GeoPosition']['Latitude']
-            lon = data[0]['GeoPosition']['Longitude']
+            location = await self._singleFlight('search', aliasKey(city_name),
+                                                lambda: self._searchLocation(city_name))
+        except QuotaExceededError:
+            stale = self.location_cache.get(city_name, allow_stale=True)
+            if stale is None:
+                raise
+            metrics.CACHE_REQUESTS.labels('location', 'stale').inc()
+            return stale
+        if location is not None:
+            return location
+
+        #AccuWeather не знает такого названия: очень близкое известное название запоминается
+        #как исправление опечатки, иначе пользователь получает подсказки
+        correction = self.alias_index.auto_match(city_name) if allow_correction else None
+        self.alias_index.remember_failed(city_name, correction)
+        if correction is None:
+            raise CityNotFoundError(self._notFoundMessage(city_name))
+        metrics.CACHE_REQUESTS.labels('location', 'corrected').inc()
+        return await self._resolveLocation(self.alias_index.display_name(correction), allow_correction=False)
+
+    def _notFoundMessage(self, city_name):
+        suggestions = [self.alias_index.display_name(key) for key, _ in self.alias_index.suggest(city_name)]
+        message = f"Город «{city_name.strip()}» не найден"
+        if suggestions:
+            message += f". Возможно, вы имели в виду: {', '.join(suggestions)}"
+        return message
+
+    async def _searchLocation(self, city_name):
+        params = {
+            'apikey': self.api_key,
+            'q': city_name
+        }
+        data = await self._requestJson('search', self.URL_LOCATION_SEARCH, params)
+        if not data:
+            return None
+        location = (
+            data[0]['Key'],
+            data[0]['GeoPosition']['Latitude'],
+            data[0]['GeoPosition']['Longitude']
+        )
+        display_name = data[0].get('LocalizedName') or city_name.strip()
+        self.location_cache.put(city_name, *location, display_name)
+        #русское и английское название из ответа становятся синонимами того же ключа,
+        #но не перезаписывают уже известные города с таким же названием
+        self.alias_index.add(city_name, display_name)
+        for alias in (data[0].get('LocalizedName'), data[0].get('EnglishName')):
+            if alias and self.location_cache.get(alias) is None:
+                self.location_cache.put(alias, *location, display_name)
+                self.alias_index.add(alias, display_name)
+        if self.geo_index is not None:
+            self.geo_index.learn(display_name, location[1], location[2], location[0])
+        return location
+
+    #город с уже известным ключом (например, точка геоиндекса) разрешается без поискового запроса
+    def rememberLocation(self, city_name, location_key, latitude, longitude):
+        if self.location_cache.get(city_name) is None:
+            self.location_cache.put(city_name, location_key, latitude, longitude, city_name.strip())
+        self.alias_index.add(city_name, city_name.strip())
+
+    async def retrieveGeoCoordinates(self, city_name):
+        try:
+            _, lat, lon = await self._resolveLocation(city_name)
             return (lat, lon)
-        except requests.exceptions.RequestException as ex:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
             raise Exception(f"Проблема с получением координат: {ex}")
 
-    def retrieveCityId(self, city_name):
+    async def retrieveCityId(self, city_name):
         try:
-            params = {
-                'apikey': self.api_key,
-                'q': city_name
-            }
-            resp = requests.get(self.URL_LOCATION_SEARCH, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-            return data[0]['Key']
-        except requests.exceptions.RequestException as ex:
+            location_key, _, _ = await self._resolveLocation(city_name)
+            return location_key
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
             raise Exception(f"Ошибка при запросе кода города: {ex}")
 
-    def gatherWeather(self, city_id, day_option):
+    async def gatherWeather(self, city_id, day_option):
+        self.request_counts[city_id] += 1
         try:
             if day_option == '1day':
-                return self._fetchDaily(city_id)
+                return await self._fetchDaily(city_id)
             elif day_option in ['3day', '5day']:
-                return self._fetchExtended(city_id, day_option)
-        except requests.exceptions.RequestException as ex:
+                return await self._fetchExtended(city_id, day_option)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
             raise Exception(f"Ошибка запроса прогноза: {ex}")
 
-    def _fetchDaily(self, city_id):
+    def _routeFetchers(self, cities, day_option):
+        semaphore = asyncio.Semaphore(self.route_concurrency)
+
+        async def fetch_city(index, city):
+            async with semaphore:
+                try:
+                    city_key = await self.retrieveCityId(city)
+                    return index, city, await self.gatherWeather(city_key, day_option), None
+                except Exception as ex:
+                    return index, city, None, ex
+
+        return [fetch_city(index, city) for index, city in enumerate(cities)]
+
+    #прогноз для всех городов маршрута параллельно, результаты (индекс в маршруте, город, прогноз, ошибка)
+    #отдаются по мере готовности; ошибка в одном городе возвращается вместе с ним и не прерывает остальные.
+    #генератор нужно закрывать (contextlib.aclosing), тогда незавершенные запросы отменяются сразу
+    async def iterRoute(self, cities, day_option):
+        tasks = [asyncio.ensure_future(fetcher) for fetcher in self._routeFetchers(cities, day_option)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    #день 0 пятидневного прогноза содержит те же поля, что и однодневный эндпоинт
+    async def _fetchDaily(self, city_id):
+        return (await self._fetchFiveDays(city_id)).day(0)
+
+    async def _fetchExtended(self, city_id, time_range):
+        limit = 3 if time_range == '3day' else 5
+        return (await self._fetchFiveDays(city_id)).head(limit)
+
+    #принудительное обновление прогноза в кэше в обход TTL
+    async def refreshForecast(self, city_id):
+        return await self._singleFlight('5day', city_id, lambda: self._downloadFiveDays(city_id))
+
+    async def _fetchFiveDays(self, city_id):
+        series = self.forecast_cache.get(city_id)
+        if series is not None:
+            metrics.CACHE_REQUESTS.labels('forecast', 'hit').inc()
+            return series
+        metrics.CACHE_REQUESTS.labels('forecast', 'miss').inc()
+        try:
+            return await self._singleFlight('5day', city_id, lambda: self._downloadFiveDays(city_id))
+        except QuotaExceededError:
+            #при нехватке квоты лучше показать устаревший прогноз, чем ошибку
+            stale = self.forecast_cache.get(city_id, allow_stale=True)
+            if stale is None:
+                raise
+            metrics.CACHE_REQUESTS.labels('forecast', 'stale').inc()
+            return stale
+
+    async def _downloadFiveDays(self, city_id):
         params = {
             'apikey': self.api_key,
             'details': 'true',
             'metric': 'true'
         }
-        resp = requests.get(self.URL_1DAY_FORECAST + city_id, params=params)
-        resp.raise_for_status()
-        json_data = resp.json()['DailyForecasts'][0]
-
-        result = {
-            'date': json_data['Date'][:10],
-            'temp': json_data['RealFeelTemperatureShade']['Minimum']['Value'],
-            'humidity': json_data['Day']['RelativeHumidity']['Average'],
-            'wind_speed': json_data['Day']['Wind']['Speed']['Value'],
-            'precipitation_probability': json_data['Day']['PrecipitationProbability']
+        data = (await self._requestJson('5day', self.URL_5DAY_FORECAST + city_id, params))['DailyForecasts']
+        series = CitySeries.from_accuweather(data, limit=5)
+        self.forecast_cache.put(city_id, series)
+        return series
+
+    def evaluate_weather(self, temperature, humidity, wind_speed, precip_chance):
+        values = {
+            'temperature': temperature,
+            'humidity': humidity,
+            'wind_speed': wind_speed,
+            'precip_chance': precip_chance
         }
-        return result
+        #условия проверяются лениво, до первого подходящего правила
+        for advice, conditions in ADVICE_RULES:
+            if all(compare(values[field], bound) for field, compare, bound in conditions):
+                return advice
 
-    def _fetchExtended(self, city_id, time_range):
-        params = {
-            'apikey': self.api_key,
-            'details': 'true',
-            'metric': 'true'
+    #пакетная оценка: каждое правило таблицы проверяется одной векторной маской сразу для всех строк,
+    #результат совпадает с поэлементным вызовом evaluate_weather
+    def evaluate_weather_batch(self, temperatures, humidities, wind_speeds, precip_chances):
+        columns = {
+            'temperature': np.asarray(temperatures, dtype=float),
+            'humidity': np.asarray(humidities, dtype=float),
+            'wind_speed': np.asarray(wind_speeds, dtype=float),
+            'precip_chance': np.asarray(precip_chances, dtype=float)
         }
-        resp = requests.get(self.URL_5DAY_FORECAST + city_id, params=params)
-        resp.raise_for_status()
+        undecided = np.ones(columns['temperature'].shape, dtype=bool)
+        rule_index = np.zeros(undecided.shape, dtype=np.intp)
 
-        data = resp.json()['DailyForecasts']
-        limit = 3 if time_range == '3day' else 5
-        forecasts = []
-        for idx in range(limit):
-            day_info = data[idx]
-            forecasts.append({
-                'date': day_info['Date'][:10],
-                'temp': day_info['RealFeelTemperatureShade']['Minimum']['Value'],
-                'humidity': day_info['Day']['RelativeHumidity']['Average'],
-                'wind_speed': day_info['Day']['Wind']['Speed']['Value'],
-                'precipitation_probability': day_info['Day']['PrecipitationProbability']
-            })
-        return forecasts
+        for idx, (_, conditions) in enumerate(ADVICE_RULES):
+            mask = undecided.copy()
+            for field, compare, bound in conditions:
+                mask &= compare(columns[field], bound)
+            rule_index[mask] = idx
+            undecided &= ~mask
+            if not undecided.any():
+                break
 
-    def evaluate_weather(self, temperature, humidity, wind_speed, precip_chance):
-        rules = [
-            ("На улице слишком холодно, рекомендуется оставаться дома", temperature <= -40),
-            ("Сильный шторм ожидается, соблюдайте осторожность", wind_speed >= 75),
-            ("Погода хорошая: умеренный ветер, тепло и маловероятен дождь",
-             11 <= wind_speed < 30 and 15 < temperature < 25 and precip_chance < 30),
-            ("Температура высокая, будьте осторожны при выходе", temperature > 40 and precip_chance < 30),
-            ("Жаркая погода с вероятностью дождя, рекомендуем взять зонт",
-             temperature > 40 and 30 <= precip_chance <= 75),
-            ("Очень высокая температура и большой шанс дождя, стоит оставаться дома",
-             temperature > 40 and precip_chance > 75),
-            ("Прохладно, но возможен дождь — одевайтесь по сезону и берите зонт",
-             0 <= temperature <= 15 and wind_speed <= 20 and precip_chance > 50),
-            ("Прохладно, дождь маловероятен, но стоит надеть легкую верхнюю одежду",
-             0 <= temperature <= 15 and wind_speed <= 20),
-            ("Ветер сильный, температура низкая — лучше остаться дома", 0 <= temperature <= 15 and wind_speed > 20),
-            ("Температура ниже нуля и дождь — хороший повод для катания на коньках",
-             temperature < 0 and precip_chance > 70),
-            ("Минусовая температура и сильный ветер — рекомендуем оставаться внутри",
-             temperature < 0 and wind_speed >= 40),
-            ("Температура ниже нуля, но относительно комфортно", temperature < 0),
-            ("Дождь с умеренным ветром и приятной температурой, будьте готовы к изменениям",
-             15 < temperature <= 40 and precip_chance > 55 and wind_speed <= 20),
-            ("Дождь и ветер — неблагоприятные условия", 15 < temperature <= 40 and precip_chance > 55),
-            ("Умеренный ветер с отсутствием дождя — зависит от ваших предпочтений",
-             15 < temperature <= 40 and precip_chance <= 55 and wind_speed <= 20),
-            ("Умеренный ветер без дождя — выбор за вами", 15 < temperature <= 40 and wind_speed > 20),
-            ("Не могу точно оценить погоду, условия неопределенные", True)
-        ]
-
-        for advice, condition in rules:
-            if condition:
-                return advice
\ No newline at end of file
+        return ADVICE_TEXTS[rule_index].tolist()
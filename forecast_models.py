@@ -0,0 +1,80 @@
+import json
+from array import array
+from dataclasses import dataclass
+
+#прогноз на один день для одного города
+@dataclass(slots=True, frozen=True)
+class DayForecast:
+    date: str
+    temp: float
+    humidity: float
+    wind_speed: float
+    precipitation_probability: float
+
+#прогноз города на несколько дней в виде колонок: даты и массивы чисел вместо словаря на каждый день
+class CitySeries:
+    __slots__ = ('dates', 'temps', 'humidity', 'wind_speed', 'precipitation_probability')
+
+    def __init__(self, dates, temps, humidity, wind_speed, precipitation_probability):
+        self.dates = dates
+        self.temps = temps
+        self.humidity = humidity
+        self.wind_speed = wind_speed
+        self.precipitation_probability = precipitation_probability
+
+    #из ответа AccuWeather берутся только нужные поля
+    @classmethod
+    def from_accuweather(cls, daily_forecasts, limit=5):
+        series = cls([], array('d'), array('d'), array('d'), array('d'))
+        for day_info in daily_forecasts[:limit]:
+            day_part = day_info['Day']
+            series.dates.append(day_info['Date'][:10])
+            series.temps.append(day_info['RealFeelTemperatureShade']['Minimum']['Value'])
+            series.humidity.append(day_part['RelativeHumidity']['Average'])
+            series.wind_speed.append(day_part['Wind']['Speed']['Value'])
+            series.precipitation_probability.append(day_part['PrecipitationProbability'])
+        return series
+
+    #JSON для общего кэша прогнозов в SQLite
+    def to_json(self):
+        return json.dumps([
+            self.dates,
+            list(self.temps),
+            list(self.humidity),
+            list(self.wind_speed),
+            list(self.precipitation_probability)
+        ])
+
+    @classmethod
+    def from_json(cls, text):
+        dates, *columns = json.loads(text)
+        return cls(dates, *(array('d', column) for column in columns))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __iter__(self):
+        for idx in range(len(self.dates)):
+            yield self.day(idx)
+
+    def day(self, idx):
+        return DayForecast(
+            self.dates[idx],
+            self.temps[idx],
+            self.humidity[idx],
+            self.wind_speed[idx],
+            self.precipitation_probability[idx]
+        )
+
+    def head(self, days):
+        return CitySeries(
+            self.dates[:days],
+            self.temps[:days],
+            self.humidity[:days],
+            self.wind_speed[:days],
+            self.precipitation_probability[:days]
+        )
+
+    #колонки дат и температур для графиков в том виде, в каком их принимает render_chart
+    def temperature_columns(self):
+        return {'dates': list(self.dates), 'temps': list(self.temps)}
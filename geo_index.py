@@ -0,0 +1,77 @@
+import json
+import math
+import os
+from dataclasses import dataclass
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+BUNDLED_CITIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cities.json')
+
+@dataclass(slots=True)
+class GeoPoint:
+    name: str
+    latitude: float
+    longitude: float
+    location_key: str = None
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+#сетка по широте и долготе: точка с геопозиции ищется только в соседних ячейках, без запросов к API
+class GeoIndex:
+    def __init__(self, cell_degrees=1.0):
+        self.cell_degrees = cell_degrees
+        self._lon_cells = int(round(360 / cell_degrees))
+        self._cells = {}
+        self._points = {}
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees) % self._lon_cells
+
+    #повторное добавление того же названия заменяет точку
+    def add(self, name, latitude, longitude, location_key=None):
+        self.remove(name)
+        point = GeoPoint(name, latitude, longitude, location_key)
+        self._points[name] = point
+        self._cells.setdefault(self._cell(latitude, longitude), []).append(point)
+        return point
+
+    #точка из ответа AccuWeather: если рядом уже есть город без ключа, ключ присваивается ему
+    def learn(self, name, latitude, longitude, location_key, merge_distance_km=5):
+        existing = self.nearest(latitude, longitude, merge_distance_km)
+        if existing is not None and existing.location_key in (None, location_key):
+            existing.location_key = location_key
+            return existing
+        return self.add(name, latitude, longitude, location_key)
+
+    def remove(self, name):
+        point = self._points.pop(name, None)
+        if point is not None:
+            self._cells[self._cell(point.latitude, point.longitude)].remove(point)
+
+    def load_bundled(self, path=BUNDLED_CITIES_PATH):
+        with open(path, encoding='utf-8') as cities_file:
+            for city in json.load(cities_file):
+                self.add(city['name'], city['latitude'], city['longitude'])
+
+    def __len__(self):
+        return len(self._points)
+
+    #ближайшая известная точка не дальше max_distance_km или None
+    def nearest(self, latitude, longitude, max_distance_km=50):
+        lat_cells = math.ceil(max_distance_km / KM_PER_DEGREE / self.cell_degrees)
+        lon_scale = max(math.cos(math.radians(min(abs(latitude) + lat_cells * self.cell_degrees, 89.9))), 1e-6)
+        lon_cells = min(math.ceil(lat_cells / lon_scale), self._lon_cells // 2)
+        row, column = self._cell(latitude, longitude)
+
+        best_point, best_distance = None, max_distance_km
+        for d_row in range(-lat_cells, lat_cells + 1):
+            for d_column in range(-lon_cells, lon_cells + 1):
+                for point in self._cells.get((row + d_row, (column + d_column) % self._lon_cells), ()):
+                    distance = haversine_km(latitude, longitude, point.latitude, point.longitude)
+                    if distance <= best_distance:
+                        best_point, best_distance = point, distance
+        return best_point
@@ -1,25 +1,88 @@
 import asyncio
+import contextlib
+import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
-from climate_engine import WeatherEngine
+import metrics
+from city_aliases import AliasIndex
+from climate_engine import ForecastCache, LocationCache, SqliteForecastCache, WeatherEngine
+from geo_index import GeoIndex
+from prefetch_scheduler import PrefetchScheduler
+from quota_manager import QuotaManager
+from result_streamer import ResultStream
+from send_scheduler import SendScheduler
+from session_store import MemorySessionStore, SqliteFSMStorage, SqliteSessionStore
+from sqlite_support import SqliteLease
+from subscription_service import DAY_OPTION_DAYS, SubscriptionDelivery, SubscriptionStore, parseSendTime
 from charting_units import (
-    create_single_day_chart,
-    create_three_day_chart,
-    create_five_day_chart
+    ChartCache,
+    days_title,
+    render_chart,
+    render_timed
 )
 
 load_dotenv()
 BOT_API_TOKEN = os.getenv('TOKEN')
 ACCUWEATHER_TOKEN = 'spjsEssJ8EuxFAXimFcaxTYL9XlzyNOT'
 
+#polling - режим для разработки, webhook - для работы нескольких процессов за балансировщиком
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1))
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 8080))
+#метрики отдаются отдельным HTTP-сервером, а не на публичном порту webhook; 0 - не отдавать.
+#без пакета prometheus_client сервер метрик не запускается
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) if metrics.prometheusAvailable else 0
+
+#маршруты и температуры пользователей живут ограниченное время, брошенные сессии вытесняются;
+#в режиме webhook состояние по умолчанию хранится в SQLite, чтобы его видел любой процесс
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite' if BOT_MODE == 'webhook' else 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.sqlite3')
+SESSION_TTL = int(os.getenv('SESSION_TTL', 24 * 3600))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 10000))
+
+def createSessionStore(namespace):
+    if SESSION_BACKEND == 'sqlite':
+        return SqliteSessionStore(SESSION_DB_PATH, namespace, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES)
+    return MemorySessionStore(ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES)
+
+def createFsmStorage():
+    redis_url = os.getenv('REDIS_URL')
+    if redis_url:
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(redis_url)
+    if SESSION_BACKEND == 'sqlite':
+        return SqliteFSMStorage(SESSION_DB_PATH, ttl=SESSION_TTL)
+    return MemoryStorage()
+
 bot_instance = Bot(token=BOT_API_TOKEN)
-mainDispatcher = Dispatcher()
+
+#все исходящие сообщения проходят через ограничитель частоты Telegram; общий лимит делится между процессами webhook
+sendScheduler = SendScheduler(
+    global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', 30)) / (WEBHOOK_WORKERS if BOT_MODE == 'webhook' else 1),
+    per_chat_rate=float(os.getenv('TELEGRAM_CHAT_RATE', 1)),
+    per_chat_burst=int(os.getenv('TELEGRAM_CHAT_BURST', 3)),
+    max_retries=int(os.getenv('TELEGRAM_MAX_RETRIES', 3))
+)
+bot_instance.session.middleware(sendScheduler)
+
+mainDispatcher = Dispatcher(storage=createFsmStorage())
 
 #состояния бота
 class CityStates(StatesGroup):
@@ -27,14 +90,185 @@ class CityStates(StatesGroup):
     cityOfDestination = State()
     cityStopovers = State()
 
-userRoutes = {}
-temperatureCache = {}
+class SubscriptionStates(StatesGroup):
+    sendTime = State()
+
+userRoutes = createSessionStore('routes')
+temperatureCache = createSessionStore('temperatures')
+#последний маршрут с прогнозом: на него можно подписаться через /subscribe
+lastRoutes = createSessionStore('last_routes')
+
+def appendRouteCity(user_id, city):
+    route = userRoutes.get(user_id, [])
+    route.append(city)
+    userRoutes.set(user_id, route)
+
+#офлайн-индекс городов для геопозиций: встроенный список и уже найденные через AccuWeather города
+locationCache = LocationCache(os.getenv('LOCATION_CACHE_PATH', 'locations_cache.sqlite3'))
+geoIndex = GeoIndex()
+geoIndex.load_bundled()
+#в кэше названия хранятся ключами вида "khimki", пользователю показывается название из ответа AccuWeather;
+#у записей старого формата его нет, они появятся в индексах после следующего поиска
+knownLocations = [entry for entry in locationCache.entries() if entry[4]]
+for _, location_key, latitude, longitude, display_name in knownLocations:
+    geoIndex.learn(display_name, latitude, longitude, location_key)
+GEO_MAX_DISTANCE_KM = float(os.getenv('GEO_MAX_DISTANCE_KM', 50))
+
+#известные названия городов для исправления опечаток и подсказок
+aliasIndex = AliasIndex(auto_match_ratio=float(os.getenv('CITY_AUTO_MATCH_RATIO', 0.8)))
+aliasIndex.load_bundled()
+for query, _, _, _, display_name in knownLocations:
+    aliasIndex.add(query, display_name)
+
+#город из сообщения: текст или ближайший известный город к отправленной геопозиции;
+#если ключ точки уже известен, прогноз для нее не потребует поискового запроса
+def routeCityFromMessage(message):
+    if message.location is None:
+        return message.text.strip()
+    point = geoIndex.nearest(message.location.latitude, message.location.longitude, GEO_MAX_DISTANCE_KM)
+    if point is None:
+        raise Exception("Не удалось определить город по геопозиции, введите его название.")
+    if point.location_key is not None:
+        weatherEngine.rememberLocation(point.name, point.location_key, point.latitude, point.longitude)
+    return point.name
+
+#прогнозы в режиме webhook хранятся в общей базе SQLite, чтобы процессы не запрашивали один город каждый сам;
+#кэши графиков, неудачных поисков и счетчики популярности городов остаются у каждого процесса свои
+FORECAST_CACHE_BACKEND = os.getenv('FORECAST_CACHE_BACKEND', 'sqlite' if BOT_MODE == 'webhook' else 'memory')
+FORECAST_CACHE_TTL = int(os.getenv('FORECAST_CACHE_TTL', 3600))
+
+def createForecastCache():
+    if FORECAST_CACHE_BACKEND == 'sqlite':
+        return SqliteForecastCache(os.getenv('FORECAST_CACHE_PATH', 'forecasts.sqlite3'), ttl=FORECAST_CACHE_TTL)
+    return ForecastCache(ttl=FORECAST_CACHE_TTL)
+
+QUOTA_DB_PATH = os.getenv('QUOTA_DB_PATH', 'quota.sqlite3')
 
 #инициализируем сервис
-weatherEngine = WeatherEngine(api_key=ACCUWEATHER_TOKEN)
+weatherEngine = WeatherEngine(
+    api_key=ACCUWEATHER_TOKEN,
+    base_url=os.getenv('ACCUWEATHER_BASE_URL'),
+    location_cache=locationCache,
+    forecast_cache=createForecastCache(),
+    geo_index=geoIndex,
+    alias_index=aliasIndex,
+    route_concurrency=int(os.getenv('ROUTE_CONCURRENCY', '4')),
+    quota=QuotaManager(
+        daily_limit=int(os.getenv('ACCUWEATHER_DAILY_LIMIT', '50')),
+        #ограничение частоты делится между процессами webhook
+        rate_per_second=float(os.getenv('ACCUWEATHER_RATE_PER_SECOND', '5')) / (
+            WEBHOOK_WORKERS if BOT_MODE == 'webhook' else 1
+        ),
+        path=QUOTA_DB_PATH,
+        #по умолчанию пользовательские запросы ждут лимит частоты, сколько потребуется
+        interactive_max_wait=float(os.getenv('ACCUWEATHER_INTERACTIVE_MAX_WAIT', 0)) or None
+    )
+)
+
+#как часто можно редактировать сообщение с результатами, пока приходят прогнозы по городам
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+
+#фоновый прогрев прогнозов популярных городов; среди процессов webhook прогревает один,
+#получивший аренду в базе квоты, остальные подхватывают ее, если он перестанет продлевать
+PREFETCH_INTERVAL = int(os.getenv('PREFETCH_INTERVAL', 60))
+prefetchScheduler = PrefetchScheduler(
+    weatherEngine,
+    top_n=int(os.getenv('PREFETCH_TOP_N', 30)),
+    batch_size=int(os.getenv('PREFETCH_BATCH_SIZE', 5)),
+    quota_share=float(os.getenv('PREFETCH_QUOTA_SHARE', 0.2)),
+    lead_time=int(os.getenv('PREFETCH_LEAD_TIME', 300)),
+    interval=PREFETCH_INTERVAL,
+    lease=SqliteLease(QUOTA_DB_PATH, 'prefetch', duration=3 * PREFETCH_INTERVAL)
+    if BOT_MODE == 'webhook' and WEBHOOK_WORKERS > 1 else None
+)
+
+#ежедневная рассылка прогнозов по сохраненным маршрутам, время подписок в SUBSCRIPTION_TZ
+SUBSCRIPTION_TZ = os.getenv('SUBSCRIPTION_TZ', 'Europe/Moscow')
+subscriptionStore = SubscriptionStore(os.getenv('SUBSCRIPTION_DB_PATH', 'subscriptions.sqlite3'))
+
+#графики рисуются в отдельных процессах, чтобы не блокировать event loop;
+#forkserver, а не fork: процессы пула запускаются из процесса с потоками aiohttp и открытыми SQLite.
+#главный модуль и matplotlib загружаются один раз в forkserver, рабочие процессы получают их готовыми
+#процессы webhook делят ядра: у каждого свой пул, поэтому по умолчанию ядра делятся между ними
+CHART_WORKERS = int(os.getenv(
+    'CHART_WORKERS', max(1, (os.cpu_count() or 1) // (WEBHOOK_WORKERS if BOT_MODE == 'webhook' else 1))
+))
+chartContext = multiprocessing.get_context('forkserver')
+chartContext.set_forkserver_preload(['__main__', 'charting_units'])
+chartPool = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=chartContext)
+
+#запуск forkserver и процессов пула занимает секунды, поэтому он делается при старте, а не в первом обработчике
+def warmChartPool():
+    return [chartPool.submit(os.getpid) for _ in range(CHART_WORKERS)]
+
+async def renderChart(chart_type, chart_function, *args):
+    loop = asyncio.get_running_loop()
+    with metrics.span('chart', chart=chart_type):
+        chart_bytes, render_seconds = await loop.run_in_executor(chartPool, render_timed, chart_function, *args)
+    metrics.CHART_RENDER_SECONDS.labels(chart_type).observe(render_seconds)
+    return chart_bytes
+
+chartCache = ChartCache(
+    max_bytes=int(os.getenv('CHART_CACHE_BYTES', 32 * 1024 * 1024)),
+    reuse_file_ids=os.getenv('CHART_CACHE_REUSE_FILE_IDS', '1') == '1'
+)
+
+#одинаковые графики не рисуются и не загружаются повторно
+async def sendChart(chat_id, chart_type, chart_function, *args):
+    chart_key = chartCache.key(chart_type, *args)
+    cached = chartCache.get(chart_key)
+    metrics.CACHE_REQUESTS.labels('chart', 'miss' if cached is None else 'hit').inc()
+    if cached is None:
+        chart_bytes = await renderChart(chart_type, chart_function, *args)
+        chartCache.put(chart_key, chart_bytes)
+        file_id = None
+    else:
+        chart_bytes, file_id = cached
+
+    if file_id is not None:
+        try:
+            return await bot_instance.send_photo(chat_id=chat_id, photo=file_id)
+        except TelegramBadRequest:
+            chartCache.forget_file_id(chart_key)
+
+    image_obj = BufferedInputFile(chart_bytes, filename=f'{chart_type}.png')
+    sent_message = await bot_instance.send_photo(chat_id=chat_id, photo=image_obj)
+    if sent_message.photo:
+        chartCache.remember_file_id(chart_key, sent_message.photo[-1].file_id)
+    return sent_message
+
+@mainDispatcher.startup()
+async def start_background_tasks():
+    warmChartPool()
+    if os.getenv('PREFETCH_ENABLED', '1') == '1':
+        prefetchScheduler.start()
+    if os.getenv('SUBSCRIPTIONS_ENABLED', '1') == '1':
+        subscriptionDelivery.start()
+
+@mainDispatcher.shutdown()
+async def release_resources():
+    await prefetchScheduler.stop()
+    await subscriptionDelivery.stop()
+    await weatherEngine.close()
+    chartPool.shutdown()
+    userRoutes.close()
+    temperatureCache.close()
+    lastRoutes.close()
+    subscriptionStore.close()
+
+#метрики: время обработчиков и использование квоты AccuWeather
+mainDispatcher.message.middleware(metrics.MetricsMiddleware())
+mainDispatcher.callback_query.middleware(metrics.MetricsMiddleware())
+
+@metrics.before_scrape
+def updateQuotaMetrics():
+    used, limit = weatherEngine.quota.usage()
+    metrics.QUOTA_USED.set(used)
+    metrics.QUOTA_LIMIT.set(limit)
 
 #выводим ошибки
 async def userErrorReport(chat_identifier, bot_obj, error_text):
+    metrics.USER_ERRORS.inc()
     await bot_obj.send_message(chat_identifier, f'Обнаружена ошибка: {error_text}')
 
 @mainDispatcher.message(F.text == '/start')
@@ -46,13 +280,55 @@ async def greet_user(message: types.Message):
 @mainDispatcher.message(F.text == '/help')
 async def help_menu(message: types.Message):
     await message.answer(
-        '/weather - комманда для того чтобы узнать погоду на маршруте'
+        '/weather - комманда для того чтобы узнать погоду на маршруте\n'
+        '/subscribe - ежедневно получать прогноз по последнему маршруту\n'
+        '/subscriptions - список подписок\n'
+        '/unsubscribe - отменить все подписки, /unsubscribe N - отменить подписку с номером N'
     )
 
+#команды подписок регистрируются раньше обработчиков с состоянием, иначе посреди диалога /weather
+#или ввода времени они были бы приняты за название города или время
+@mainDispatcher.message(F.text == '/subscribe')
+async def begin_subscription(message: types.Message, state: FSMContext):
+    try:
+        if not lastRoutes.get(message.from_user.id):
+            raise Exception("Сначала получите прогноз по маршруту через /weather, затем подпишитесь на него.")
+        await state.set_state(SubscriptionStates.sendTime)
+        await message.answer(f'Введите время ежедневного прогноза в формате ЧЧ:ММ ({SUBSCRIPTION_TZ}):')
+    except Exception as err:
+        await userErrorReport(message.chat.id, bot_instance, err)
+
+@mainDispatcher.message(F.text == '/subscriptions')
+async def list_subscriptions(message: types.Message):
+    try:
+        subscriptions = subscriptionStore.list(message.chat.id)
+        if not subscriptions:
+            await message.answer('У вас нет подписок. Используйте /subscribe после прогноза по маршруту.')
+            return
+        await message.answer('\n'.join(
+            f"{subscription_id}. {' → '.join(route)}, в {send_time}, прогноз на {DAY_OPTION_DAYS[day_option]} дн."
+            for subscription_id, route, day_option, send_time in subscriptions
+        ))
+    except Exception as err:
+        await userErrorReport(message.chat.id, bot_instance, err)
+
+@mainDispatcher.message(F.text.startswith('/unsubscribe'))
+async def cancel_subscription(message: types.Message):
+    try:
+        argument = message.text.removeprefix('/unsubscribe').strip()
+        if argument and not argument.isdigit():
+            raise Exception("Укажите номер подписки из /subscriptions, например /unsubscribe 3.")
+        removed = subscriptionStore.remove(message.chat.id, int(argument) if argument else None)
+        if not removed:
+            raise Exception("Подписка не найдена.")
+        await message.answer('Подписка отменена.' if argument else f'Отменено подписок: {removed}.')
+    except Exception as err:
+        await userErrorReport(message.chat.id, bot_instance, err)
+
 @mainDispatcher.message(F.text == '/weather')
 async def begin_weather_flow(message: types.Message, state: FSMContext):
     try:
-        userRoutes[message.from_user.id] = []
+        userRoutes.set(message.from_user.id, [])
         await state.set_state(CityStates.cityOfOrigin)
         await message.answer('Введите город отправлеия:')
     except Exception as err:
@@ -61,7 +337,7 @@ async def begin_weather_flow(message: types.Message, state: FSMContext):
 @mainDispatcher.message((F.text | F.location), CityStates.cityOfOrigin)
 async def ask_destination_city(message: types.Message, state: FSMContext):
     try:
-        userRoutes[message.from_user.id].append(message.text.strip())
+        appendRouteCity(message.from_user.id, routeCityFromMessage(message))
         await state.set_state(CityStates.cityOfDestination)
         await message.answer('Введите город, являющийся концом маршрута:')
     except Exception as err:
@@ -70,7 +346,7 @@ async def ask_destination_city(message: types.Message, state: FSMContext):
 @mainDispatcher.message((F.text | F.location), CityStates.cityOfDestination)
 async def handle_stopovers_question(message: types.Message, state: FSMContext):
     try:
-        userRoutes[message.from_user.id].append(message.text.strip())
+        appendRouteCity(message.from_user.id, routeCityFromMessage(message))
         markup_stopovers = InlineKeyboardMarkup(inline_keyboard=[[
             InlineKeyboardButton(text='Да', callback_data='wanna_stop'),
             InlineKeyboardButton(text='Нет', callback_data='no_stop')
@@ -93,10 +369,10 @@ async def add_stopover_city(callback: types.CallbackQuery, state: FSMContext):
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
 #получаем промежуточные города
-@mainDispatcher.message(F.text, CityStates.cityStopovers)
+@mainDispatcher.message((F.text | F.location), CityStates.cityStopovers)
 async def collect_stopovers(message: types.Message, state: FSMContext):
     try:
-        userRoutes[message.from_user.id].append(message.text.strip())
+        appendRouteCity(message.from_user.id, routeCityFromMessage(message))
         markup_more_stops = InlineKeyboardMarkup(inline_keyboard=[[
             InlineKeyboardButton(text='Да', callback_data='wanna_stop'),
             InlineKeyboardButton(text='Нет', callback_data='no_stop')
@@ -122,49 +398,96 @@ async def choose_forecast_period(callback: types.CallbackQuery, state: FSMContex
     except Exception as err:
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
+def formatDayForecast(city, day_info, summary, wind_label):
+    return (
+        f"Город: {city}\n"
+        f"Дата: {day_info.date}\n"
+        f"Температура: {day_info.temp}°C\n"
+        f"Влажность: {day_info.humidity:g}%\n"
+        f"{wind_label}: {day_info.wind_speed} км/ч\n"
+        f"Вероятность осадков: {day_info.precipitation_probability:g}%\n"
+        f"Анализ: {summary}\n\n"
+    )
+
+subscriptionDelivery = SubscriptionDelivery(
+    weatherEngine,
+    subscriptionStore,
+    send_message=bot_instance.send_message,
+    format_day=formatDayForecast,
+    timezone=SUBSCRIPTION_TZ,
+    interval=int(os.getenv('SUBSCRIPTION_CHECK_INTERVAL', 30)),
+    send_workers=int(os.getenv('SUBSCRIPTION_SEND_WORKERS', 8)),
+    concurrency=int(os.getenv('ROUTE_CONCURRENCY', '4'))
+)
+
+#текст прогноза по одному городу и температуры для графика
+def formatCityForecast(city, forecast, day_option):
+    if day_option == '1day':
+        summary = weatherEngine.evaluate_weather(
+            forecast.temp,
+            forecast.humidity,
+            forecast.wind_speed,
+            forecast.precipitation_probability
+        )
+        return formatDayForecast(city, forecast, summary, 'Скорость ветра'), {
+            'dates': [forecast.date],
+            'temps': [forecast.temp]
+        }
+
+    daily_advices = weatherEngine.evaluate_weather_batch(
+        forecast.temps,
+        forecast.humidity,
+        forecast.wind_speed,
+        forecast.precipitation_probability
+    )
+    city_text = ''.join(
+        formatDayForecast(city, day_info, summary, 'Ветер')
+        for day_info, summary in zip(forecast, daily_advices)
+    )
+    return city_text, forecast.temperature_columns()
+
+#прогноз по маршруту отправляется по мере готовности каждого города, длинный текст делится на сообщения
+async def streamRouteForecast(callback, day_option, chart_callback_data):
+    user_id = callback.from_user.id
+    route = userRoutes.get(user_id, [])
+    if not route:
+        raise Exception("Маршрут пуст. Используйте /weather, чтобы задать города.")
+
+    stream = ResultStream(bot_instance, callback.message.chat.id, route, min_edit_interval=STREAM_EDIT_INTERVAL)
+    route_temperatures = [None] * len(route)
+    try:
+        async with contextlib.aclosing(weatherEngine.iterRoute(route, day_option)) as route_results:
+            async for index, city, forecast, city_error in route_results:
+                if city_error is not None:
+                    await stream.update(index, f"Город: {city}\nОшибка: {city_error}\n\n")
+                    continue
+                city_text, route_temperatures[index] = formatCityForecast(city, forecast, day_option)
+                await stream.update(index, city_text)
+        await stream.finish()
+    except Exception as err:
+        #прогноз прерван: вместо "Загрузка прогноза..." у оставшихся городов показывается ошибка
+        with contextlib.suppress(Exception):
+            await stream.abort(err)
+        raise
+
+    #колонки дат и температур для графика сохраняются в порядке маршрута и передаются в render_chart как есть
+    temperatureCache.set(user_id, {
+        city: temperatures for city, temperatures in zip(route, route_temperatures) if temperatures is not None
+    })
+    lastRoutes.set(user_id, {'route': route, 'day_option': day_option})
+    userRoutes.delete(user_id)
+
+    see_chart_markup = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text='Да', callback_data=chart_callback_data),
+        InlineKeyboardButton(text='Нет', callback_data='no_chart')
+    ]])
+    await callback.message.answer('Показать температуру на графике?', reply_markup=see_chart_markup)
+
 @mainDispatcher.callback_query(F.data == 'forecast_1')
 async def forecast_for_one_day(callback: types.CallbackQuery):
     try:
         await callback.answer()
-        user_id = callback.from_user.id
-        temperatureCache[user_id] = {}
-
-        results_message = ''
-        for city in userRoutes.get(user_id, []):
-            cityKey = weatherEngine.retrieveCityId(city)
-            one_day_data = weatherEngine.gatherWeather(cityKey, '1day')
-            analysis_result = weatherEngine.evaluate_weather(
-                one_day_data['temp'],
-                one_day_data['humidity'],
-                one_day_data['wind_speed'],
-                one_day_data['precipitation_probability']
-            )
-
-            if isinstance(analysis_result, str):
-                summary, level_info = analysis_result, '—'
-            else:
-                summary = '. '.join(analysis_result[:-1])
-                level_info = analysis_result[-1]
-
-            temperatureCache[user_id][city] = one_day_data['temp']
-            results_message += (
-                f"Город: {city}\n"
-                f"Дата: {one_day_data['date']}\n"
-                f"Температура: {one_day_data['temp']}°C\n"
-                f"Влажность: {one_day_data['humidity']}%\n"
-                f"Скорость ветра: {one_day_data['wind_speed']} км/ч\n"
-                f"Вероятность осадков: {one_day_data['precipitation_probability']}%\n"
-                f"Анализ: {summary}\n\n"
-            )
-
-        await callback.message.answer(results_message)
-        userRoutes[user_id] = []
-
-        see_chart_markup = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text='Да', callback_data='show_chart_1'),
-            InlineKeyboardButton(text='Нет', callback_data='no_chart')
-        ]])
-        await callback.message.answer('Показать температуру на графике?', reply_markup=see_chart_markup)
+        await streamRouteForecast(callback, '1day', 'show_chart_1')
     except Exception as err:
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
@@ -172,48 +495,7 @@ async def forecast_for_one_day(callback: types.CallbackQuery):
 async def forecast_for_three_days(callback: types.CallbackQuery):
     try:
         await callback.answer()
-        user_id = callback.from_user.id
-        temperatureCache[user_id] = {}
-
-        results_message = ''
-        for city in userRoutes.get(user_id, []):
-            cityKey = weatherEngine.retrieveCityId(city)
-            three_day_data = weatherEngine.gatherWeather(cityKey, '3day')
-            temperatureCache[user_id][city] = []
-
-            for day_info in three_day_data:
-                daily_analysis = weatherEngine.evaluate_weather(
-                    day_info['temp'],
-                    day_info['humidity'],
-                    day_info['wind_speed'],
-                    day_info['precipitation_probability']
-                )
-
-                if isinstance(daily_analysis, str):
-                    summary, level_info = daily_analysis, '—'
-                else:
-                    summary = '. '.join(daily_analysis[:-1])
-                    level_info = daily_analysis[-1]
-
-                temperatureCache[user_id][city].append((day_info['date'], day_info['temp']))
-                results_message += (
-                    f"Город: {city}\n"
-                    f"Дата: {day_info['date']}\n"
-                    f"Температура: {day_info['temp']}°C\n"
-                    f"Влажность: {day_info['humidity']}%\n"
-                    f"Ветер: {day_info['wind_speed']} км/ч\n"
-                    f"Вероятность осадков: {day_info['precipitation_probability']}%\n"
-                    f"Анализ: {summary}\n\n"
-                )
-
-        await callback.message.answer(results_message)
-        userRoutes[user_id] = []
-
-        see_chart_markup = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text='Да', callback_data='display_3_chart'),
-            InlineKeyboardButton(text='Нет', callback_data='no_chart')
-        ]])
-        await callback.message.answer('Показать температуру на графике?', reply_markup=see_chart_markup)
+        await streamRouteForecast(callback, '3day', 'display_3_chart')
     except Exception as err:
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
@@ -221,48 +503,7 @@ async def forecast_for_three_days(callback: types.CallbackQuery):
 async def forecast_for_five_days(callback: types.CallbackQuery):
     try:
         await callback.answer()
-        user_id = callback.from_user.id
-        temperatureCache[user_id] = {}
-
-        results_message = ''
-        for city in userRoutes.get(user_id, []):
-            cityKey = weatherEngine.retrieveCityId(city)
-            five_day_data = weatherEngine.gatherWeather(cityKey, '5day')
-            temperatureCache[user_id][city] = []
-
-            for day_info in five_day_data:
-                daily_analysis = weatherEngine.evaluate_weather(
-                    day_info['temp'],
-                    day_info['humidity'],
-                    day_info['wind_speed'],
-                    day_info['precipitation_probability']
-                )
-
-                if isinstance(daily_analysis, str):
-                    summary, level_info = daily_analysis, '—'
-                else:
-                    summary = '. '.join(daily_analysis[:-1])
-                    level_info = daily_analysis[-1]
-
-                temperatureCache[user_id][city].append((day_info['date'], day_info['temp']))
-                results_message += (
-                    f"Город: {city}\n"
-                    f"Дата: {day_info['date']}\n"
-                    f"Температура: {day_info['temp']}°C\n"
-                    f"Влажность: {day_info['humidity']}%\n"
-                    f"Ветер: {day_info['wind_speed']} км/ч\n"
-                    f"Вероятность осадков: {day_info['precipitation_probability']}%\n"
-                    f"Анализ: {summary}\n\n"
-                )
-
-        await callback.message.answer(results_message)
-        userRoutes[user_id] = []
-
-        see_chart_markup = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text='Да', callback_data='display_5_chart'),
-            InlineKeyboardButton(text='Нет', callback_data='no_chart')
-        ]])
-        await callback.message.answer('Показать температуру на графике?', reply_markup=see_chart_markup)
+        await streamRouteForecast(callback, '5day', 'display_5_chart')
     except Exception as err:
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
@@ -270,8 +511,8 @@ async def forecast_for_five_days(callback: types.CallbackQuery):
 async def no_graphics_response(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        userRoutes[user_id] = []
-        temperatureCache[user_id] = {}
+        userRoutes.delete(user_id)
+        temperatureCache.delete(user_id)
         await callback.answer()
         await callback.message.answer('Спасибо за использование бота!')
     except Exception as err:
@@ -286,10 +527,9 @@ async def display_three_day_chart(callback: types.CallbackQuery):
         if not stored_data:
             raise Exception("Нет достаточных данных для построения графика.")
 
-        chart_path = create_three_day_chart(stored_data)
-        image_obj = FSInputFile(path=chart_path)
-        await bot_instance.send_photo(chat_id=callback.message.chat.id, photo=image_obj)
-        os.remove(chart_path)
+        await sendChart(
+            callback.message.chat.id, 'three_day', render_chart, 'line', f'Температура за {days_title(3)}', stored_data
+        )
     except Exception as err:
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
@@ -302,10 +542,9 @@ async def display_five_day_chart(callback: types.CallbackQuery):
         if not stored_data:
             raise Exception("Недостаточно данных для построения графика.")
 
-        chart_path = create_five_day_chart(stored_data)
-        image_obj = FSInputFile(path=chart_path)
-        await bot_instance.send_photo(chat_id=callback.message.chat.id, photo=image_obj)
-        os.remove(chart_path)
+        await sendChart(
+            callback.message.chat.id, 'five_day', render_chart, 'line', f'Температура за {days_title(5)}', stored_data
+        )
     except Exception as err:
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
@@ -318,24 +557,104 @@ async def display_single_day_chart(callback: types.CallbackQuery):
         if not stored_data:
             raise Exception("Недостаточно данных для построения графика.")
 
-        city_list = list(stored_data.keys())
-        temp_list = list(stored_data.values())
-
-        chart_path = create_single_day_chart(temp_list, city_list)
-        image_obj = FSInputFile(path=chart_path)
-        await bot_instance.send_photo(chat_id=callback.message.chat.id, photo=image_obj)
-        os.remove(chart_path)
+        await sendChart(
+            callback.message.chat.id, 'single_day', render_chart, 'bar', f'Сравнение температур ({days_title(1)})',
+            stored_data
+        )
     except Exception as err:
         await userErrorReport(callback.message.chat.id, bot_instance, err)
 
+@mainDispatcher.message(F.text, SubscriptionStates.sendTime)
+async def save_subscription(message: types.Message, state: FSMContext):
+    try:
+        send_time = parseSendTime(message.text)
+        if send_time is None:
+            raise Exception("Время должно быть в формате ЧЧ:ММ, например 08:30.")
+        last_route = lastRoutes.get(message.from_user.id)
+        if not last_route:
+            raise Exception("Маршрут не найден. Используйте /weather, чтобы задать города.")
+        subscription_id = subscriptionDelivery.subscribe(
+            message.chat.id, last_route['route'], send_time, last_route['day_option']
+        )
+        await state.clear()
+        await message.answer(
+            f"Подписка {subscription_id} оформлена: прогноз по маршруту {' → '.join(last_route['route'])} "
+            f"будет приходить ежедневно в {send_time}."
+        )
+    except Exception as err:
+        await userErrorReport(message.chat.id, bot_instance, err)
+
 @mainDispatcher.message()
 async def unknown_input(message: types.Message):
     await message.answer(
         'Я не понимаю эту комманду. Введите /help чтобы узнать о возможностях'
     )
 
+async def startMetricsServer(port):
+    metrics_runner = web.AppRunner(metrics.create_metrics_app())
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+    return metrics_runner
+
+def createWebhookApp(metrics_port=0):
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=mainDispatcher,
+        bot=bot_instance,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, mainDispatcher, bot=bot_instance)
+    if metrics_port:
+        async def metricsServer(app):
+            metrics_runner = await startMetricsServer(metrics_port)
+            yield
+            await metrics_runner.cleanup()
+
+        app.cleanup_ctx.append(metricsServer)
+    return app
+
+#каждый процесс слушает один и тот же порт (SO_REUSEPORT), ядро распределяет между ними соединения.
+#в режиме multiprocess метрики всех процессов отдает главный процесс, иначе процесс с номером N
+#отдает свои метрики на METRICS_PORT + N
+def runWebhookWorker(worker_index=0):
+    metrics_port = 0
+    if METRICS_PORT and (WEBHOOK_WORKERS == 1 or not metrics.multiprocessEnabled):
+        metrics_port = METRICS_PORT + worker_index
+    web.run_app(createWebhookApp(metrics_port), host=WEBAPP_HOST, port=WEBAPP_PORT, reuse_port=WEBHOOK_WORKERS > 1)
+
+async def registerWebhook():
+    await bot_instance.set_webhook(WEBHOOK_BASE_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    await bot_instance.session.close()
+
+def run_webhook():
+    asyncio.run(registerWebhook())
+    if WEBHOOK_WORKERS == 1:
+        runWebhookWorker()
+        return
+    #spawn, а не fork: у каждого процесса свои соединения с SQLite и свой event loop
+    spawn_context = multiprocessing.get_context('spawn')
+    workers = [
+        spawn_context.Process(target=runWebhookWorker, args=(worker_index,)) for worker_index in range(WEBHOOK_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    if METRICS_PORT and metrics.multiprocessEnabled:
+        web.run_app(metrics.create_metrics_app(), host=METRICS_HOST, port=METRICS_PORT)
+    for worker in workers:
+        worker.join()
+        metrics.mark_process_dead(worker.pid)
+
 if __name__ == '__main__':
+    if metrics.tracingEnabled:
+        logging.basicConfig(level=logging.INFO)
+
     async def main_run():
+        if METRICS_PORT:
+            await startMetricsServer(METRICS_PORT)
+        await bot_instance.delete_webhook()
         await mainDispatcher.start_polling(bot_instance)
 
-    asyncio.run(main_run())
\ No newline at end of file
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        asyncio.run(main_run())
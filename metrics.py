@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import time
+import uuid
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+#метрики prometheus_client. Пакет необязателен: без него метрики ничего не считают, а /metrics не запускается.
+#без PROMETHEUS_MULTIPROC_DIR каждый процесс считает только свои события; если каталог задан
+#(в окружении до запуска, а не в .env, и пустой), процессы webhook пишут значения в файлы каталога,
+#а /metrics отдает сумму по всем процессам
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+    from prometheus_client import generate_latest, multiprocess
+except ImportError:
+    prometheusAvailable = False
+else:
+    prometheusAvailable = True
+
+multiprocessEnabled = prometheusAvailable and bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+class _NoopMetric:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def labels(self, *labelvalues):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+if not prometheusAvailable:
+    Counter = Gauge = Histogram = _NoopMetric
+
+#метрики бота
+HANDLER_LATENCY = Histogram('bot_handler_latency_seconds', 'Время работы обработчиков aiogram', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors', 'Исключения, вышедшие из обработчиков', ['handler'])
+USER_ERRORS = Counter('bot_user_errors', 'Ошибки, показанные пользователю')
+UPSTREAM_LATENCY = Histogram('accuweather_request_latency_seconds', 'Время запросов к AccuWeather', ['endpoint'])
+UPSTREAM_RESPONSES = Counter('accuweather_responses', 'Ответы AccuWeather по кодам статуса', ['endpoint', 'status'])
+UPSTREAM_COALESCED = Counter('accuweather_coalesced_requests', 'Запросы, объединенные с уже выполняющимися', ['endpoint'])
+#квота общая для всех процессов, поэтому берется максимум, а не сумма
+QUOTA_USED = Gauge('accuweather_quota_used', 'Использовано запросов из дневного лимита', multiprocess_mode='livemax')
+QUOTA_LIMIT = Gauge('accuweather_quota_limit', 'Дневной лимит запросов к AccuWeather', multiprocess_mode='livemax')
+CACHE_REQUESTS = Counter('bot_cache_requests', 'Обращения к кэшам по результату (hit, miss, stale, corrected, negative)', ['cache', 'result'])
+CHART_RENDER_SECONDS = Histogram('bot_chart_render_seconds', 'Время построения графика в рабочем процессе', ['chart'])
+PREFETCH_REFRESHES = Counter('bot_prefetch_refreshes', 'Фоновые обновления прогнозов популярных городов', ['result'])
+SUBSCRIPTION_BATCH_SECONDS = Histogram('bot_subscription_batch_seconds', 'Время подготовки пакета рассылки по подпискам')
+SUBSCRIPTION_MESSAGES = Counter('bot_subscription_messages', 'Сообщения рассылки по подпискам', ['result'])
+SEND_QUEUE_DEPTH = Gauge('bot_send_queue_depth', 'Исходящие сообщения, ожидающие лимита Telegram', ['priority'],
+                         multiprocess_mode='livesum')
+SEND_WAIT_SECONDS = Histogram('bot_send_wait_seconds', 'Ожидание отправки из-за лимитов Telegram', ['priority'])
+SEND_RETRY_AFTER = Counter('bot_send_retry_after', 'Ответы Telegram с требованием повторить позже (429)')
+
+#структурированные спаны: при TRACE_SPANS=1 каждый спан пишется в лог строкой JSON
+tracingEnabled = os.getenv('TRACE_SPANS', '0') == '1'
+spanLogger = logging.getLogger('tracing')
+_currentSpan = ContextVar('_currentSpan', default=None)
+
+class span:
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        parent = _currentSpan.get()
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = uuid.uuid4().hex[:16]
+        self._token = _currentSpan.set(self)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self._started
+        _currentSpan.reset(self._token)
+        if tracingEnabled:
+            spanLogger.info(json.dumps({
+                'span': self.name,
+                'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'duration_ms': round(duration * 1000, 3),
+                'error': exc_type.__name__ if exc_type else None,
+                **self.attributes
+            }, ensure_ascii=False, default=str))
+        return False
+
+#внутренний middleware диспетчера: время каждого обработчика по его имени
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        handler_name = handler_object.callback.__name__ if handler_object else 'unknown'
+        started = time.perf_counter()
+        try:
+            with span('handler', handler=handler_name):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(handler_name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(handler_name).observe(time.perf_counter() - started)
+
+#функции, обновляющие значения, которые читаются из внешних источников (например, квота из SQLite)
+_scrapeHooks = []
+
+def before_scrape(function):
+    _scrapeHooks.append(function)
+    return function
+
+def render():
+    if not prometheusAvailable:
+        return b''
+    for hook in _scrapeHooks:
+        hook()
+    if not multiprocessEnabled:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+#завершившийся процесс webhook больше не участвует в live-метриках
+def mark_process_dead(pid):
+    if multiprocessEnabled:
+        multiprocess.mark_process_dead(pid)
+
+async def metrics_handler(request):
+    if not prometheusAvailable:
+        return web.Response(status=503, text='prometheus_client не установлен')
+    return web.Response(body=render(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+def create_metrics_app():
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    return app
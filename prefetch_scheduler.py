@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+
+import metrics
+from quota_manager import PRIORITY_BACKGROUND, QuotaExceededError, requestPriority
+
+logger = logging.getLogger(__name__)
+
+#фоновая задача, которая обновляет прогнозы самых популярных городов незадолго до истечения их TTL,
+#чтобы пользовательские запросы обслуживались из кэша.
+#при нескольких процессах прогрев выполняет только владелец аренды lease (SqliteLease),
+#популярность городов он оценивает по своей доле трафика
+class PrefetchScheduler:
+    def __init__(self, engine, top_n=30, batch_size=5, quota_share=0.2, lead_time=300, interval=60,
+                 half_life=None, lease=None):
+        self.engine = engine
+        self.lease = lease
+        self.top_n = top_n
+        self.batch_size = batch_size
+        #доля дневного лимита AccuWeather, которую может потратить прогрев; расход хранится
+        #в DailyBudget отдельным счетчиком и не обнуляется при перезапуске или смене процесса
+        self.quota_share = quota_share
+        self.lead_time = lead_time
+        self.interval = interval
+        #частоты затухают вдвое за время жизни прогноза в кэше: популярность отражает трафик,
+        #ради которого прогноз еще стоит держать свежим
+        self.half_life = half_life or engine.forecast_cache.ttl
+        self.decay = 0.5 ** (interval / self.half_life)
+        self._task = None
+
+    #списывает из бюджета прогрева столько обновлений, сколько он позволяет, не больше count
+    def _reserve(self, count):
+        if self.engine.quota is None:
+            return count
+        budget = self.engine.quota.budget
+        limit = int(budget.daily_limit * self.quota_share)
+        reserved = 0
+        while reserved < count and budget.consume(limit, scope='prefetch'):
+            reserved += 1
+        return reserved
+
+    def _candidates(self):
+        deadline = time.time() + self.lead_time
+        candidates = []
+        for location_key, _ in self.engine.request_counts.most_common(self.top_n):
+            expires_at = self.engine.forecast_cache.expires_at(location_key)
+            if expires_at is None or expires_at <= deadline:
+                candidates.append(location_key)
+        return candidates
+
+    async def _refresh(self, location_key):
+        try:
+            await self.engine.refreshForecast(location_key)
+            metrics.PREFETCH_REFRESHES.labels('ok').inc()
+        except QuotaExceededError:
+            metrics.PREFETCH_REFRESHES.labels('quota').inc()
+        except Exception:
+            metrics.PREFETCH_REFRESHES.labels('error').inc()
+
+    async def refresh_once(self):
+        requestPriority.set(PRIORITY_BACKGROUND)
+        candidates = self._candidates()
+        candidates = candidates[:self._reserve(len(candidates))]
+
+        for start in range(0, len(candidates), self.batch_size):
+            batch = candidates[start:start + self.batch_size]
+            await asyncio.gather(*(self._refresh(location_key) for location_key in batch))
+
+        for location_key in list(self.engine.request_counts):
+            self.engine.request_counts[location_key] *= self.decay
+            if self.engine.request_counts[location_key] < 0.5:
+                del self.engine.request_counts[location_key]
+        return len(candidates)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if self.lease is None or self.lease.acquire():
+                    await self.refresh_once()
+            except Exception:
+                logger.exception('Ошибка фонового прогрева прогнозов')
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.lease is not None:
+            self.lease.release()
@@ -0,0 +1,144 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from sqlite_support import connectSqlite
+
+#приоритеты запросов: пользовательские запросы обслуживаются раньше фонового обновления
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+#приоритет текущей задачи, фоновые задачи выставляют PRIORITY_BACKGROUND
+requestPriority = ContextVar('requestPriority', default=PRIORITY_INTERACTIVE)
+
+class QuotaExceededError(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens=1):
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    #сколько секунд ждать, пока в ведре появится нужное число токенов
+    def wait_time(self, tokens=1):
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.wait_time(tokens))
+
+#дневной счетчик запросов к API, хранится в SQLite и переживает перезапуски
+class DailyBudget:
+    def __init__(self, daily_limit, path=':memory:'):
+        self.daily_limit = daily_limit
+        self._db = connectSqlite(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS quota_usage (day TEXT PRIMARY KEY, used INTEGER NOT NULL)')
+        self._db.commit()
+
+    #scope ведет отдельный счетчик за тот же день (например, расход прогрева) в строке "день/scope"
+    @staticmethod
+    def _today(scope=None):
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        return today if scope is None else f'{today}/{scope}'
+
+    def used(self, scope=None):
+        row = self._db.execute('SELECT used FROM quota_usage WHERE day = ?', (self._today(scope),)).fetchone()
+        return row[0] if row else 0
+
+    def remaining(self):
+        return max(0, self.daily_limit - self.used())
+
+    #списание атомарно, поэтому счетчик можно делить между несколькими процессами бота
+    def consume(self, limit=None, scope=None):
+        limit = self.daily_limit if limit is None else limit
+        if limit <= 0:
+            return False
+        cursor = self._db.execute(
+            'INSERT INTO quota_usage VALUES (?, 1) '
+            'ON CONFLICT(day) DO UPDATE SET used = used + 1 WHERE used < ?',
+            (self._today(scope), limit)
+        )
+        self._db.commit()
+        return cursor.rowcount == 1
+
+    #API сообщил, что лимит ключа исчерпан: локальный счетчик догоняет реальный до конца дня
+    def exhaust(self):
+        self._db.execute(
+            'INSERT INTO quota_usage VALUES (?, ?) ON CONFLICT(day) DO UPDATE SET used = MAX(used, excluded.used)',
+            (self._today(), self.daily_limit)
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+#учет квоты AccuWeather: ведро токенов на каждый эндпоинт и общий дневной бюджет
+class QuotaManager:
+    def __init__(self, daily_limit=50, rate_per_second=5, burst=5, path=':memory:',
+                 interactive_reserve=0.2, max_wait=2.0, interactive_max_wait=None):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        #доля дневного бюджета, которую фоновые запросы не могут занять
+        self.interactive_reserve = interactive_reserve
+        #сколько фоновый запрос ждет лимит частоты, прежде чем отказаться;
+        #пользовательские запросы по умолчанию (None) ждут своей очереди без ограничения
+        self.max_wait = max_wait
+        self.interactive_max_wait = interactive_max_wait
+        self.budget = DailyBudget(daily_limit, path)
+        self._buckets = {}
+        self._interactive_waiting = 0
+
+    def _bucket(self, endpoint):
+        if endpoint not in self._buckets:
+            self._buckets[endpoint] = TokenBucket(self.rate_per_second, self.burst)
+        return self._buckets[endpoint]
+
+    async def acquire(self, endpoint, priority=None):
+        priority = requestPriority.get() if priority is None else priority
+        bucket = self._bucket(endpoint)
+        max_wait = self.interactive_max_wait if priority == PRIORITY_INTERACTIVE else self.max_wait
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+
+        if priority == PRIORITY_INTERACTIVE:
+            self._interactive_waiting += 1
+        try:
+            #фоновые запросы пропускают вперед ожидающие пользовательские
+            while (priority != PRIORITY_INTERACTIVE and self._interactive_waiting) or not bucket.try_acquire():
+                delay = max(bucket.wait_time(), 0.01)
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    raise QuotaExceededError(f'Превышен лимит частоты запросов к AccuWeather ({endpoint})')
+                await asyncio.sleep(delay)
+        finally:
+            if priority == PRIORITY_INTERACTIVE:
+                self._interactive_waiting -= 1
+
+        limit = self.budget.daily_limit
+        if priority != PRIORITY_INTERACTIVE:
+            limit = int(limit * (1 - self.interactive_reserve))
+        if not self.budget.consume(limit):
+            raise QuotaExceededError('Исчерпан дневной лимит запросов к AccuWeather')
+
+    def exhaust(self):
+        self.budget.exhaust()
+
+    def usage(self):
+        return self.budget.used(), self.budget.daily_limit
+
+    def close(self):
+        self.budget.close()
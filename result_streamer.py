@@ -0,0 +1,78 @@
+import time
+
+#максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+#делит текст на части не длиннее limit: по границам блоков, внутри слишком длинного блока - по строкам
+def splitMessage(blocks, limit=TELEGRAM_MESSAGE_LIMIT):
+    pieces = []
+    for block in blocks:
+        if len(block) <= limit:
+            pieces.append(block)
+            continue
+        for line in block.splitlines(keepends=True):
+            while len(line) > limit:
+                pieces.append(line[:limit])
+                line = line[limit:]
+            pieces.append(line)
+
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + len(piece) > limit:
+            chunks.append(current)
+            current = ''
+        current += piece
+    if current:
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+#показывает результаты по мере готовности: блок каждого города встает на свое место в маршруте,
+#сообщения редактируются, а при превышении лимита длины текст продолжается в новых сообщениях
+class ResultStream:
+    def __init__(self, bot, chat_id, cities, min_edit_interval=1.0, limit=TELEGRAM_MESSAGE_LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.min_edit_interval = min_edit_interval
+        self.limit = limit
+        self.cities = list(cities)
+        self.blocks = [f'Город: {city}\nЗагрузка прогноза...\n\n' for city in cities]
+        self._pending = set(range(len(self.cities)))
+        self._message_ids = []
+        self._sent_texts = []
+        self._last_flush = 0.0
+
+    async def update(self, index, text):
+        self.blocks[index] = text
+        self._pending.discard(index)
+        #первый результат отправляется сразу, последующие правки не чаще min_edit_interval
+        if time.monotonic() - self._last_flush >= self.min_edit_interval:
+            await self._flush()
+
+    async def finish(self):
+        await self._flush()
+
+    #обработка прервалась: города, для которых прогноз так и не пришел, показываются с ошибкой
+    async def abort(self, error):
+        for index in sorted(self._pending):
+            self.blocks[index] = f'Город: {self.cities[index]}\nОшибка: {error}\n\n'
+        self._pending.clear()
+        await self._flush()
+
+    async def _flush(self):
+        self._last_flush = time.monotonic()
+        chunks = splitMessage(self.blocks, self.limit)
+        for idx, chunk in enumerate(chunks):
+            if idx < len(self._message_ids):
+                if chunk != self._sent_texts[idx]:
+                    await self.bot.edit_message_text(text=chunk, chat_id=self.chat_id, message_id=self._message_ids[idx])
+                    self._sent_texts[idx] = chunk
+            else:
+                message = await self.bot.send_message(self.chat_id, chunk)
+                self._message_ids.append(message.message_id)
+                self._sent_texts.append(chunk)
+
+        #текст стал короче и занимает меньше сообщений: лишние удаляем
+        while len(self._message_ids) > len(chunks):
+            await self.bot.delete_message(chat_id=self.chat_id, message_id=self._message_ids.pop())
+            self._sent_texts.pop()
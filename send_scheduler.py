@@ -0,0 +1,116 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from aiogram import methods
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+import metrics
+from quota_manager import PRIORITY_INTERACTIVE, TokenBucket, requestPriority
+
+#методы, которые отправляют или меняют сообщения и попадают под ограничения частоты Telegram
+FLOOD_LIMITED_METHODS = (
+    methods.SendMessage,
+    methods.SendPhoto,
+    methods.SendDocument,
+    methods.SendMediaGroup,
+    methods.EditMessageText,
+    methods.EditMessageCaption,
+    methods.EditMessageReplyMarkup,
+    methods.CopyMessage,
+    methods.ForwardMessage,
+    methods.DeleteMessage
+)
+
+PRIORITY_LABELS = {PRIORITY_INTERACTIVE: 'interactive'}
+
+def _priorityLabel(priority):
+    return PRIORITY_LABELS.get(priority, 'bulk')
+
+#middleware сессии бота: все исходящие сообщения проходят через общее ведро токенов и ведро чата,
+#ответы пользователям идут раньше массовой рассылки, а ответ 429 (retry after) ставит чат на паузу
+#и запрос повторяется, а не теряется
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate=30, per_chat_rate=1, per_chat_burst=3, group_rate=20 / 60, max_retries=3,
+                 max_chats=10000):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        #в группах Telegram разрешает около 20 сообщений в минуту
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self._paused_until = {}
+        self._interactive_ready = 0
+        self._waiting = {}
+
+    #у групп и каналов отрицательный chat_id
+    def _chatBucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.per_chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, 1 if is_group else self.per_chat_burst)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _chatDelay(self, chat_id, bucket):
+        return max(bucket.wait_time(), self._paused_until.get(chat_id, 0) - time.monotonic())
+
+    def queue_depth(self, priority):
+        return self._waiting.get(priority, 0)
+
+    def _setWaiting(self, priority, delta):
+        self._waiting[priority] = self._waiting.get(priority, 0) + delta
+        metrics.SEND_QUEUE_DEPTH.labels(_priorityLabel(priority)).set(self._waiting[priority])
+
+    async def acquire(self, chat_id, priority=None):
+        priority = requestPriority.get() if priority is None else priority
+        bucket = self._chatBucket(chat_id)
+        started = time.monotonic()
+        ready = False
+        self._setWaiting(priority, 1)
+        try:
+            while True:
+                delay = self._chatDelay(chat_id, bucket)
+                if delay <= 0:
+                    #массовые сообщения не берут общий токен, пока его ждет ответ пользователю
+                    can_take = priority == PRIORITY_INTERACTIVE or not self._interactive_ready
+                    if can_take and self._global.try_acquire():
+                        bucket.try_acquire()
+                        break
+                    if priority == PRIORITY_INTERACTIVE and not ready:
+                        ready = True
+                        self._interactive_ready += 1
+                    delay = self._global.wait_time()
+                await asyncio.sleep(max(delay, 0.005))
+        finally:
+            if ready:
+                self._interactive_ready -= 1
+            self._setWaiting(priority, -1)
+        metrics.SEND_WAIT_SECONDS.labels(_priorityLabel(priority)).observe(time.monotonic() - started)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(method, FLOOD_LIMITED_METHODS) or chat_id is None:
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            await self.acquire(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as ex:
+                metrics.SEND_RETRY_AFTER.inc()
+                if attempt >= self.max_retries:
+                    raise
+                #чат ставится на паузу, остальные чаты продолжают получать сообщения
+                self._paused_until[chat_id] = time.monotonic() + ex.retry_after
+                attempt += 1
+            finally:
+                if self._paused_until.get(chat_id, 0) <= time.monotonic():
+                    self._paused_until.pop(chat_id, None)
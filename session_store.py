@@ -0,0 +1,143 @@
+import json
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from sqlite_support import connectSqlite
+
+#хранилища пользовательских сессий (маршруты, температуры для графиков) с временем жизни записи
+#и ограничением по числу записей: давно не использованные сессии вытесняются первыми
+
+class MemorySessionStore:
+    def __init__(self, ttl=24 * 3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self._entries.clear()
+
+#значения хранятся в JSON, поэтому кортежи возвращаются списками;
+#один файл базы может делиться между несколькими хранилищами через namespace и между процессами.
+#get только читает: время использования копится в памяти и пишется вместе с ближайшим set,
+#а удаление просроченных и вытеснение лишних записей выполняется не чаще cleanup_interval
+class SqliteSessionStore:
+    def __init__(self, path, namespace, ttl=24 * 3600, max_entries=10000, cleanup_interval=60, timeout=0.5):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cleanup_interval = cleanup_interval
+        self._touched = {}
+        self._cleaned_at = time.monotonic()
+        self._db = connectSqlite(path, timeout=timeout)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'expires_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (namespace, key))'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (namespace, last_used)')
+        self._db.commit()
+
+    def get(self, key, default=None):
+        now = time.time()
+        row = self._db.execute(
+            'SELECT value, expires_at FROM sessions WHERE namespace = ? AND key = ?',
+            (self.namespace, str(key))
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return default
+        self._touched[str(key)] = now
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        self._touched.pop(str(key), None)
+        self._db.execute(
+            'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)',
+            (self.namespace, str(key), json.dumps(value, ensure_ascii=False), now + self.ttl, now)
+        )
+        if time.monotonic() - self._cleaned_at >= self.cleanup_interval:
+            self._cleanup(now)
+        self._db.commit()
+
+    def _cleanup(self, now):
+        self._cleaned_at = time.monotonic()
+        if self._touched:
+            self._db.executemany(
+                'UPDATE sessions SET last_used = ? WHERE namespace = ? AND key = ?',
+                [(last_used, self.namespace, key) for key, last_used in self._touched.items()]
+            )
+            self._touched.clear()
+        self._db.execute('DELETE FROM sessions WHERE namespace = ? AND expires_at <= ?', (self.namespace, now))
+        self._db.execute(
+            'DELETE FROM sessions WHERE namespace = ? AND key IN ('
+            'SELECT key FROM sessions WHERE namespace = ? ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, self.max_entries)
+        )
+
+    def delete(self, key):
+        self._touched.pop(str(key), None)
+        self._db.execute('DELETE FROM sessions WHERE namespace = ? AND key = ?', (self.namespace, str(key)))
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute(
+            'SELECT COUNT(*) FROM sessions WHERE namespace = ? AND expires_at > ?', (self.namespace, time.time())
+        ).fetchone()[0]
+
+    def close(self):
+        self._cleanup(time.time())
+        self._db.commit()
+        self._db.close()
+
+#FSM-хранилище aiogram поверх SqliteSessionStore: состояние диалога доступно любому процессу бота
+class SqliteFSMStorage(BaseStorage):
+    def __init__(self, path, ttl=24 * 3600, max_entries=100000):
+        self._records = SqliteSessionStore(path, 'fsm', ttl=ttl, max_entries=max_entries)
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key, state=None):
+        record_key = self._key_builder.build(key)
+        record = self._records.get(record_key, {})
+        record['state'] = state.state if isinstance(state, State) else state
+        self._records.set(record_key, record)
+
+    async def get_state(self, key):
+        return self._records.get(self._key_builder.build(key), {}).get('state')
+
+    async def set_data(self, key, data):
+        record_key = self._key_builder.build(key)
+        record = self._records.get(record_key, {})
+        record['data'] = dict(data)
+        self._records.set(record_key, record)
+
+    async def get_data(self, key):
+        return dict(self._records.get(self._key_builder.build(key), {}).get('data', {}))
+
+    async def close(self):
+        self._records.close()
@@ -0,0 +1,51 @@
+import sqlite3
+import time
+import uuid
+
+#общие настройки SQLite для баз, которые делят процессы бота: в режиме WAL чтение не ждет писателя,
+#synchronous=NORMAL убирает fsync из каждого commit, а короткий busy timeout не дает
+#блокировке файла надолго остановить event loop
+def connectSqlite(path, timeout=0.5):
+    db = sqlite3.connect(path, check_same_thread=False, timeout=timeout)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+#аренда на время: из нескольких процессов бота фоновую задачу выполняет только владелец строки,
+#владелец продлевает аренду, а если процесс завершился, ее забирает другой после истечения срока
+class SqliteLease:
+    def __init__(self, path, name, duration=180):
+        self.name = name
+        self.duration = duration
+        self.owner = uuid.uuid4().hex
+        self._db = connectSqlite(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._db.commit()
+
+    def acquire(self):
+        now = time.time()
+        try:
+            cursor = self._db.execute(
+                'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE '
+                'SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.owner = excluded.owner OR leases.expires_at <= ?',
+                (self.name, self.owner, now + self.duration, now)
+            )
+            self._db.commit()
+        except sqlite3.OperationalError:
+            #база занята другим процессом: считаем, что аренда не получена, попробуем в следующий раз
+            return False
+        return cursor.rowcount == 1
+
+    #если база занята, аренда просто истечет сама
+    def release(self):
+        try:
+            self._db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (self.name, self.owner))
+            self._db.commit()
+        except sqlite3.OperationalError:
+            pass
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import metrics
+from city_aliases import aliasKey
+from quota_manager import PRIORITY_BACKGROUND, requestPriority
+from result_streamer import splitMessage
+from sqlite_support import connectSqlite
+
+logger = logging.getLogger(__name__)
+
+_TIME_PATTERN = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+
+DAY_OPTION_DAYS = {'1day': 1, '3day': 3, '5day': 5}
+
+#время рассылки в формате ЧЧ:ММ или None, если строка не похожа на время
+def parseSendTime(text):
+    match = _TIME_PATTERN.match(text.strip())
+    if match is None:
+        return None
+    return f'{int(match.group(1)):02d}:{match.group(2)}'
+
+#подписки на ежедневный прогноз по сохраненному маршруту, хранятся в SQLite
+class SubscriptionStore:
+    def __init__(self, path=':memory:'):
+        self._db = connectSqlite(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS subscriptions ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, route TEXT NOT NULL, '
+            'day_option TEXT NOT NULL, send_time TEXT NOT NULL, last_sent TEXT)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS subscriptions_chat ON subscriptions (chat_id)')
+        self._db.commit()
+
+    #если время рассылки на сегодня уже прошло, первая рассылка будет завтра
+    def add(self, chat_id, route, send_time, day_option, today, now_time):
+        cursor = self._db.execute(
+            'INSERT INTO subscriptions (chat_id, route, day_option, send_time, last_sent) VALUES (?, ?, ?, ?, ?)',
+            (chat_id, json.dumps(route, ensure_ascii=False), day_option, send_time,
+             today if send_time <= now_time else None)
+        )
+        self._db.commit()
+        return cursor.lastrowid
+
+    def remove(self, chat_id, subscription_id=None):
+        if subscription_id is None:
+            cursor = self._db.execute('DELETE FROM subscriptions WHERE chat_id = ?', (chat_id,))
+        else:
+            cursor = self._db.execute(
+                'DELETE FROM subscriptions WHERE chat_id = ? AND id = ?', (chat_id, subscription_id)
+            )
+        self._db.commit()
+        return cursor.rowcount
+
+    def list(self, chat_id):
+        rows = self._db.execute(
+            'SELECT id, route, day_option, send_time FROM subscriptions WHERE chat_id = ? ORDER BY send_time, id',
+            (chat_id,)
+        ).fetchall()
+        return [(row[0], json.loads(row[1]), row[2], row[3]) for row in rows]
+
+    #подписки, время которых наступило, помечаются отправленными одним запросом,
+    #поэтому при нескольких процессах бота каждую забирает только один из них;
+    #пока наступивших подписок нет, проверка только читает и не берет блокировку записи
+    def claim_due(self, today, now_time):
+        due_filter = 'send_time <= ? AND (last_sent IS NULL OR last_sent != ?)'
+        has_due = self._db.execute(
+            f'SELECT 1 FROM subscriptions WHERE {due_filter} LIMIT 1', (now_time, today)
+        ).fetchone()
+        if has_due is None:
+            return []
+        rows = self._db.execute(
+            'UPDATE subscriptions SET last_sent = ? '
+            f'WHERE {due_filter} RETURNING id, chat_id, route, day_option',
+            (today, now_time, today)
+        ).fetchall()
+        self._db.commit()
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+#пакетная рассылка: города всех наступивших подписок объединяются, каждый ключ локации
+#запрашивается один раз, советы считаются одной векторной оценкой, сообщения уходят через очередь
+class SubscriptionDelivery:
+    def __init__(self, engine, store, send_message, format_day, timezone='Europe/Moscow', interval=30,
+                 send_workers=8, concurrency=4):
+        self.engine = engine
+        self.store = store
+        self.send_message = send_message
+        self.format_day = format_day
+        self.timezone = ZoneInfo(timezone)
+        self.interval = interval
+        self.concurrency = concurrency
+        self.send_workers = send_workers
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._sender_tasks = []
+
+    def now(self):
+        local_now = datetime.now(self.timezone)
+        return local_now.strftime('%Y-%m-%d'), local_now.strftime('%H:%M')
+
+    def subscribe(self, chat_id, route, send_time, day_option):
+        return self.store.add(chat_id, route, send_time, day_option, *self.now())
+
+    async def _resolveCities(self, cities):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def resolve(city):
+            async with semaphore:
+                try:
+                    return city, await self.engine.retrieveCityId(city), None
+                except Exception as ex:
+                    return city, None, ex
+
+        return await asyncio.gather(*(resolve(city) for city in cities))
+
+    async def _fetchForecasts(self, location_keys):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(location_key):
+            async with semaphore:
+                try:
+                    return location_key, await self.engine.gatherWeather(location_key, '5day'), None
+                except Exception as ex:
+                    return location_key, None, ex
+
+        return await asyncio.gather(*(fetch(location_key) for location_key in location_keys))
+
+    #советы для всех дней всех городов за один вызов evaluate_weather_batch
+    def _adviceByKey(self, forecasts):
+        ordered = list(forecasts.items())
+        columns = ([], [], [], [])
+        for _, series in ordered:
+            columns[0].extend(series.temps)
+            columns[1].extend(series.humidity)
+            columns[2].extend(series.wind_speed)
+            columns[3].extend(series.precipitation_probability)
+        advices = self.engine.evaluate_weather_batch(*columns) if columns[0] else []
+
+        advice_by_key = {}
+        offset = 0
+        for location_key, series in ordered:
+            advice_by_key[location_key] = advices[offset:offset + len(series)]
+            offset += len(series)
+        return advice_by_key
+
+    def _cityBlock(self, city, location, forecasts, advice_by_key, day_option):
+        location_key, error = location
+        if error is None and isinstance(forecasts[location_key], Exception):
+            error = forecasts[location_key]
+        if error is not None:
+            return f"Город: {city}\nОшибка: {error}\n\n"
+        days = DAY_OPTION_DAYS[day_option]
+        series = forecasts[location_key]
+        wind_label = 'Скорость ветра' if day_option == '1day' else 'Ветер'
+        return ''.join(
+            self.format_day(city, day_info, summary, wind_label)
+            for day_info, summary in zip(series.head(days), advice_by_key[location_key][:days])
+        )
+
+    async def deliver_due(self):
+        due = self.store.claim_due(*self.now())
+        if not due:
+            return 0
+        started = time.perf_counter()
+        with metrics.span('subscriptions', subscriptions=len(due)):
+            #одинаковые по смыслу названия ("Москва", "мск") разрешаются один раз
+            unique_cities = {}
+            for _, _, route, _ in due:
+                for city in route:
+                    unique_cities.setdefault(aliasKey(city), city)
+            locations = {
+                aliasKey(city): (location_key, error)
+                for city, location_key, error in await self._resolveCities(list(unique_cities.values()))
+            }
+
+            location_keys = {location_key for location_key, error in locations.values() if error is None}
+            forecasts = {}
+            for location_key, series, error in await self._fetchForecasts(sorted(location_keys)):
+                forecasts[location_key] = series if error is None else error
+            advice_by_key = self._adviceByKey({
+                location_key: series for location_key, series in forecasts.items()
+                if not isinstance(series, Exception)
+            })
+
+            for _, chat_id, route, day_option in due:
+                blocks = ['Ежедневный прогноз по маршруту:\n\n'] + [
+                    self._cityBlock(city, locations[aliasKey(city)], forecasts, advice_by_key, day_option)
+                    for city in route
+                ]
+                for chunk in splitMessage(blocks):
+                    self._queue.put_nowait((chat_id, chunk))
+        metrics.SUBSCRIPTION_BATCH_SECONDS.observe(time.perf_counter() - started)
+        return len(due)
+
+    #частоту отправки ограничивает SendScheduler сессии бота: рассылка помечена как фоновая
+    #и пропускает вперед ответы пользователям, несколько отправителей не дают одному чату задержать остальные
+    async def _send_loop(self):
+        requestPriority.set(PRIORITY_BACKGROUND)
+        while True:
+            chat_id, text = await self._queue.get()
+            try:
+                await self.send_message(chat_id, text)
+                metrics.SUBSCRIPTION_MESSAGES.labels('sent').inc()
+            except Exception:
+                metrics.SUBSCRIPTION_MESSAGES.labels('error').inc()
+                logger.exception('Не удалось отправить рассылку в чат %s', chat_id)
+            finally:
+                self._queue.task_done()
+
+    #поиск городов и прогнозы рассылки уступают квоту и очередь AccuWeather запросам пользователей
+    async def run(self):
+        requestPriority.set(PRIORITY_BACKGROUND)
+        while True:
+            try:
+                await self.deliver_due()
+            except Exception:
+                logger.exception('Ошибка пакетной рассылки')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._sender_tasks = [task for task in self._sender_tasks if not task.done()]
+        while len(self._sender_tasks) < self.send_workers:
+            self._sender_tasks.append(asyncio.create_task(self._send_loop()))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        for task in [self._task, *self._sender_tasks]:
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._sender_tasks = []